@@ -21,25 +21,49 @@ version = 1//1 ; ''' These two lines are
 # > sudo easy_install pip
 # > pip install --user psycopg2
 
+# NumPy Installation (only needed for --vector):
+########################
+# > pip install --user numpy
+
 ## Import required librarys:
 import os
 import re
 import sys
-import csv
+import ast
 import json
 import time
+import zlib
+import copy
+import fcntl
+import array
+import heapq
+import shlex
 import types
+import Queue
 import urllib
+import struct
+import random
+import atexit
+import shutil
+import bisect
+import select
 import getpass
 import sqlite3
+import termios
 import hashlib
+import cPickle
+import marshal
 import argparse
 import textwrap
 import StringIO
 import datetime
-import fileinput
+import tempfile
+import itertools
+import threading
 import subprocess
+import __builtin__
 import collections
+import multiprocessing
 
 # Import optional librarys:
 try: import pysam ; pysamInstalled = True
@@ -48,6 +72,8 @@ try: import hts ; from cffi import FFI as ffi; htspythonInstalled = True
 except: htspythonInstalled = False
 try: import psycopg2 ; postgresInstalled = True
 except: postgresInstalled = False
+try: import numpy ; numpyInstalled = True
+except: numpyInstalled = False
 
 ##############################
 ## Define DATA READER classes
@@ -62,8 +88,1441 @@ class PysamDataReader(object):
         pass
 
 class SamtoolsDataReader(object):
-    def __init__(self):
-        pass
+    """
+    Reads SAM text, either from a SAM file or from "samtools view -h" piped into stdin. The input is read
+    in large chunks and split into lines in bulk. Each line is then only tab-split as far as the highest
+    column the stats actually use (so unused columns and tags are never sliced out), and the placeholder
+    values are normalised once here rather than in every stat: POS/PNEXT become 0-based ints (so "0"
+    becomes -1, like BAM), FLAG/MAPQ/TLEN become ints, "*" RNAME/RNEXT become "Unmapped", an "=" RNEXT becomes
+    the RNAME, and a "*" CIGAR/SEQ/QUAL becomes None.
+    """
+    CHUNK = 4*1024*1024
+
+    def __init__(self, handle, columns, allColumns=False):
+        self.handle = handle
+        self.columns = set(range(11)) if allColumns else set(columns)
+        if 6 in self.columns: self.columns.add(2) # Needed to resolve "=" in RNEXT
+        self.split = -1 if allColumns else max(self.columns | set([0])) + 1
+        self.batches = self.lines()
+        self.readHeader()
+        self.records = self.makeDecoder()
+
+    def lines(self):
+        ## Yields lists of complete lines, one list per chunk read.
+        leftover = ''
+        while True:
+            chunk = self.handle.read(self.CHUNK)
+            if not chunk: break
+            lines = (leftover + chunk).split('\n')
+            leftover = lines.pop()
+            yield lines
+        if leftover: yield [leftover]
+
+    def readHeader(self):
+        headerLines = []
+        self.pending = []
+        for lines in self.batches:
+            x = 0
+            while x < len(lines) and lines[x].startswith('@'): x += 1
+            headerLines += lines[:x]
+            if x < len(lines):
+                self.pending = lines[x:]
+                break
+        self.header = parseSamHeader('\n'.join(headerLines))
+
+    def makeDecoder(self):
+        normalise = {
+            1:  ['read[1] = int(read[1])'],
+            2:  ['if read[2] == "*": read[2] = "Unmapped"'],
+            3:  ['read[3] = int(read[3]) - 1'],
+            4:  ['read[4] = int(read[4])'],
+            5:  ['if read[5] == "*": read[5] = None'],
+            6:  ['if read[6] == "=": read[6] = read[2]', 'elif read[6] == "*": read[6] = "Unmapped"'],
+            7:  ['read[7] = int(read[7]) - 1'],
+            8:  ['read[8] = int(read[8])'],
+            9:  ['if read[9] == "*": read[9] = None'],
+            10: ['if read[10] == "*": read[10] = None']
+        }
+        code  = 'def records(batches):\n'
+        code += '    try:\n'
+        code += '        for lines in batches:\n'
+        code += '            for line in lines:\n'
+        code += '                if not line: continue\n'
+        code += '                read = line.split("\\t", ' + str(self.split) + ')\n'
+        for column in sorted(self.columns):
+            for line in normalise.get(column,[]): code += '                ' + line + '\n'
+        code += '                yield read\n'
+        code += '    except (IndexError, ValueError):\n'
+        code += '        raise CorruptFile("Malformed SAM line: " + line[:100])\n'
+        namespace = {'CorruptFile':CorruptFile}
+        exec(code, namespace)
+        self.code = code
+        return namespace['records']
+
+    def __iter__(self):
+        return self.records(itertools.chain([self.pending], self.batches))
+
+class FastqDataReader(object):
+    """
+    Reads FASTQ - plain, gzipped, or BGZF (which is just gzip in many small members) - for pre-alignment QC. The
+    input is inflated and split into lines in large chunks, and each chunk's records are made by slicing every
+    4th line out in bulk. Like the built-in BAM reader, it is given the fq_* variables the stats use (fq_name,
+    fq_seq, fq_qual) and yields tuples of just those, which collect_data unpacks straight into variables (see
+    self.target). fq_name is the read ID up to the first whitespace, without the @, same as a SAM QNAME.
+    Sequences wrapped over multiple lines are not supported.
+    """
+    CHUNK = 4*1024*1024
+    FIELDS = ('fq_name','fq_seq','fq_qual')
+
+    def __init__(self, handle, fields):
+        self.handle = handle
+        self.fields = [ field for field in self.FIELDS if field in fields ]
+        self.target = '(' + ','.join(self.fields) + ',)' if self.fields else 'read'
+        self.header = {}
+
+    def chunks(self):
+        ## Yields the (inflated) text of the file a chunk at a time.
+        data = self.handle.read(self.CHUNK)
+        if not data.startswith('\x1f\x8b'):
+            while data:
+                yield data
+                data = self.handle.read(self.CHUNK)
+            return
+        inflater = zlib.decompressobj(31)
+        while data:
+            try: yield inflater.decompress(data)
+            except zlib.error: raise CorruptFile('FASTQ file is not valid gzip.')
+            while inflater.unused_data:                # The start of the next gzip member.
+                data = inflater.unused_data
+                inflater = zlib.decompressobj(31)
+                try: yield inflater.decompress(data)
+                except zlib.error: raise CorruptFile('FASTQ file is not valid gzip.')
+            data = self.handle.read(self.CHUNK)
+
+    def __iter__(self):
+        leftover = ''
+        for chunk in self.chunks():
+            if '\r' in chunk: chunk = chunk.replace('\r','')
+            lines = (leftover + chunk).split('\n')
+            end = (len(lines) - 1) // 4 * 4           # The last line is never complete, and records are 4 lines.
+            leftover = '\n'.join(lines[end:])
+            for record in self.records(lines, end): yield record
+        lines = leftover.rstrip('\n').split('\n') if leftover.strip() else []
+        if len(lines) % 4 or (lines and len(lines[-1]) != len(lines[-3])): raise CorruptFile('FASTQ file is truncated.')
+        for record in self.records(lines, len(lines)): yield record
+
+    def records(self, lines, end):
+        names, plus = lines[0:end:4], lines[2:end:4]
+        if not all([ name[:1] == '@' for name in names ]) or not all([ line[:1] == '+' for line in plus ]):
+            raise CorruptFile('Malformed FASTQ record near: ' + ' '.join(names[:1]))
+        if not self.fields: return itertools.repeat((), len(names))
+        columns = []
+        for field in self.fields:
+            if field == 'fq_name': columns.append([ name[1:].split(None,1)[0] if name[1:] else '' for name in names ])
+            if field == 'fq_seq':  columns.append(lines[1:end:4])
+            if field == 'fq_qual': columns.append(lines[3:end:4])
+        return itertools.izip(*columns)
+
+## Raised by the built-in readers when the input file is not what it claims to be (or is truncated).
+class CorruptFile(Exception): pass
+
+## This function checks to see if a file is binary (BAM) or ASCII (SAM) by looking for a "null byte" (0x00) in the first 20Mb of the file.
+def bamCheck(fileName):
+    with open(fileName, 'rb') as xamfile:
+        for i in range(10): # 10 tries to find a null byte in 2Mb chunks.
+            section = xamfile.read(2048)
+            if '\0' in section:            return True  # BAM file.
+            if len(section) < 2048:
+                if i == 0 and not section: return None  # Empty file.
+                else:                      return False # SAM file.
+
+## FASTQ (plain or gzipped) is recognised by its first record: a line starting with @, a line, and then a line starting with +.
+## This must be checked before bamCheck, as a gzipped FASTQ looks just as binary as a BAM.
+def fastqCheck(fileName):
+    with open(fileName, 'rb') as f: data = f.read(65536)
+    if data.startswith('\x1f\x8b'):
+        try: data = zlib.decompressobj(31).decompress(data)
+        except zlib.error: return False
+    lines = data.replace('\r','').split('\n', 4)
+    return len(lines) > 3 and lines[0][:1] == '@' and lines[2][:1] == '+' and '\t' not in lines[0]
+
+## Parses the text of a SAM header into the same dictionary layout pysam uses, so stats can treat the header
+## the same way regardless of file reader. If the text has no @SQ lines (allowed in BAM), the binary reference list is used.
+def parseSamHeader(text, references=(), lengths=()):
+    header = {}
+    for line in text.splitlines():
+        if not line.startswith('@'): continue
+        record = line[1:3]
+        if record == 'CO':
+            header.setdefault('CO',[]).append(line[4:])
+            continue
+        fields = {}
+        for field in line.split('\t')[1:]:
+            key,_,value = field.partition(':')
+            fields[key] = int(value) if key == 'LN' and value.isdigit() else value
+        if record == 'HD': header['HD'] = fields
+        else:              header.setdefault(record,[]).append(fields)
+    if references and 'SQ' not in header:
+        header['SQ'] = [ {'SN':name,'LN':length} for name,length in zip(references,lengths) ]
+    return header
+
+## Helpers for the BamDataReader's generated record decoder. They are only called for the variable-length parts
+## of a record (CIGAR, SEQ, QUAL, tags), and only if a stat actually asked for that part.
+bamSeqCodes  = '=ACMGRSVTWYHKDBN'
+bamSeqTable  = dict( (chr(x), bamSeqCodes[x >> 4] + bamSeqCodes[x & 15]) for x in xrange(256) ) # 1 byte = 2 bases
+bamQualTable = ''.join( chr((x+33) & 255) for x in xrange(256) )                                # phred to ASCII+33
+bamGCTable   = ''.join( chr((x >> 4 in (2,4)) + (x & 15 in (2,4))) for x in xrange(256) )      # 1 byte = how many of its 2 bases are C/G
+bamATTable   = ''.join( chr((x >> 4 in (1,8)) + (x & 15 in (1,8))) for x in xrange(256) )      # 1 byte = how many of its 2 bases are A/T
+bamTagTypes  = { 'c':'b', 'C':'B', 's':'h', 'S':'H', 'i':'i', 'I':'I', 'f':'f', 'd':'d' }      # BAM type to struct type
+bamTagSizes  = { 'A':1, 'c':1, 'C':1, 's':2, 'S':2, 'i':4, 'I':4, 'f':4, 'd':8 }                # Bytes taken by fixed-size tag values
+
+def bamCigar(data, start, n_cigar):
+    if n_cigar == 0: return None
+    return ''.join([ str(op >> 4) + 'MIDNSHP=X'[op & 15] for op in struct.unpack_from('<%dI' % n_cigar, data, start) ])
+
+def bamRefLength(data, start, n_cigar):
+    ## How many reference bases an alignment covers (the M, D, N, = and X operations of its CIGAR).
+    length = 0
+    for op in struct.unpack_from('<%dI' % n_cigar, data, start):
+        if op & 15 in (0,2,3,7,8): length += op >> 4
+    return length
+
+def bamSeq(data, start, l_seq):
+    if l_seq == 0: return None
+    return ''.join(map(bamSeqTable.__getitem__, data[start:start+(l_seq+1)//2]))[:l_seq]
+
+def bamGC(data, start, l_seq):
+    ## GC% straight from the packed sequence, so no SEQ string is built. Each byte is translated to its number of C/G (or A/T)
+    ## bases, and counting the 1s and 2s adds them up. The padding half of the last byte of an odd-length read is '=', so counts as neither.
+    packed = data[start:start+(l_seq+1)//2]
+    cg, at = packed.translate(bamGCTable), packed.translate(bamATTable)
+    cg = cg.count('\x01') + 2*cg.count('\x02')
+    at = at.count('\x01') + 2*at.count('\x02')
+    if cg + at == 0: return None
+    return (cg*100) / (at+cg)
+
+def bamQual(data, start, l_seq):
+    if l_seq == 0 or data[start] == '\xff': return None
+    return data[start:start+l_seq].translate(bamQualTable)
+
+def bamTagValue(data, p, tag, valueType):
+    ## Unpacks the value of one tag starting at p. Returns the value and where the next tag starts.
+    if valueType == 'Z' or valueType == 'H':
+        q = data.index('\0', p)
+        return data[p:q], q + 1
+    elif valueType == 'A':
+        return data[p], p + 1
+    elif valueType == 'B':
+        arrayFormat = '<%d%s' % (struct.unpack_from('<i', data, p+1)[0], bamTagTypes[data[p]])
+        return list(struct.unpack_from(arrayFormat, data, p+5)), p + 5 + struct.calcsize(arrayFormat)
+    try: valueFormat = '<' + bamTagTypes[valueType]
+    except KeyError: raise CorruptFile('Unknown type "' + valueType + '" for tag ' + tag)
+    return struct.unpack_from(valueFormat, data, p)[0], p + struct.calcsize(valueFormat)
+
+def bamTags(data, p, end):
+    tags = []
+    while p < end:
+        tag, valueType = data[p:p+2], data[p+2]
+        value, p = bamTagValue(data, p+3, tag, valueType)
+        tags.append((tag,value))
+    return tags
+
+def bamTag(data, p, end, wanted):
+    ## For TAG('XX') - only the value of the tag wanted is unpacked. Every tag before it is just skipped over.
+    while p < end:
+        tag, valueType = data[p:p+2], data[p+2]
+        if tag == wanted: return bamTagValue(data, p+3, tag, valueType)[0]
+        if valueType in bamTagSizes: p += 3 + bamTagSizes[valueType]
+        elif valueType == 'Z' or valueType == 'H': p = data.index('\0', p+3) + 1
+        else: p = bamTagValue(data, p+3, tag, valueType)[1]
+    return None
+
+## The other readers' versions of TAG('XX'). A SAM read's tags are still text, so only the "i" and "f" types are converted.
+def samTag(read, wanted):
+    wanted += ':'
+    for tag in read[11:]:
+        if tag.startswith(wanted):
+            if tag[3] == 'i': return int(tag[5:])
+            if tag[3] == 'f': return float(tag[5:])
+            return tag[5:]
+    return None
+
+def pysamTag(read, wanted):
+    try: return read.opt(wanted)
+    except KeyError: return None
+
+def htsTag(read, wanted):
+    for tag in read.tags:
+        if tag[0] == wanted: return tag[2]
+    return None
+
+## How each reader looks up a single tag. For the built-in BAM reader each tag becomes a field of its own, like bam_tag_RG.
+tagAccessors = { 'sam':'samTag(read, "%s")', 'pysam':'pysamTag(read, "%s")', 'htspython':'htsTag(read, "%s")', 'pybam':'bam_tag_%s' }
+
+def withTagAccessors(method, fileReader):
+    ## Stats ask for one optional tag with TAG('RG'), rather than going through every tag on the read with TAGS.
+    ## That is swapped here for the cheapest way the reader has of getting at just that tag.
+    if not method or fileReader not in tagAccessors: return method
+    return re.sub(r'''\bTAG\(\s*['"](\w\w)['"]\s*\)''', lambda match: tagAccessors[fileReader].replace('%s', match.group(1)), method)
+
+def inflateBlock(compressed):
+    if compressed is None: return None
+    try: return zlib.decompress(compressed, -15)
+    except zlib.error as e: raise CorruptFile('Could not decompress BGZF block: ' + str(e))
+
+class InflatePipeline(object):
+    """
+    Inflates BGZF blocks on a pool of threads (zlib lets go of the GIL while it works), keeping up to
+    'depth' blocks read and inflated ahead of whatever is consuming them. Blocks come out in file order.
+    When it finishes it reports how often each end of the queue had to wait (a "*" line to the parent's
+    supervisor, which adds it to the file's Completed message), which is what you want to know when picking
+    --threads: if the consumer waits a lot, add threads. If the queue is mostly full, the stats are the
+    bottleneck and more threads will not help.
+    """
+    def __init__(self, rawBlocks, threads, depth=None):
+        self.threads = threads
+        self.depth = depth or threads * 4
+        self.ready = Queue.Queue(self.depth) # Slots in file order. This is what bounds how far ahead we get.
+        self.work = Queue.Queue()            # Slots waiting for a thread to inflate them.
+        self.consumerWaits, self.consumerWaited, self.queueFull = 0, 0.0, 0
+        threads = [ threading.Thread(target=self.feed, args=(rawBlocks,)) ]
+        threads += [ threading.Thread(target=self.inflate) for x in range(self.threads) ]
+        for thread in threads:
+            thread.daemon = True # If the consumer stops early, these are left blocked on the queues. That's fine.
+            thread.start()
+
+    def feed(self, rawBlocks):
+        ## Reads the compressed blocks in order, giving each a slot for its inflated data.
+        try:
+            for compressed in rawBlocks:
+                slot = [threading.Event(), None, None] # [done, inflated data, error]
+                if compressed is None: slot[0].set()   # Markers (like the end of a byte range) are passed straight through.
+                else:                  self.work.put((slot, compressed))
+                if self.ready.full(): self.queueFull += 1
+                self.ready.put(slot)
+        except Exception as e:
+            slot = [threading.Event(), None, e]
+            slot[0].set()
+            self.ready.put(slot)
+        self.ready.put(False)
+
+    def inflate(self):
+        while True:
+            slot, compressed = self.work.get()
+            try: slot[1] = inflateBlock(compressed)
+            except CorruptFile as e: slot[2] = e
+            slot[0].set()
+
+    def __iter__(self):
+        try:
+            while True:
+                try: slot = self.ready.get_nowait()
+                except Queue.Empty: slot = None
+                if slot is None or not (slot is False or slot[0].is_set()):
+                    waitStart = time.time()
+                    if slot is None: slot = self.ready.get()
+                    if slot is not False: slot[0].wait()
+                    self.consumerWaits += 1
+                    self.consumerWaited += time.time() - waitStart
+                if slot is False: return
+                if slot[2] is not None: raise slot[2]
+                yield slot[1]
+        finally:
+            sys.stdout.write('* %d %d %d %.3f %d\n' % (self.threads, self.depth, self.consumerWaits, self.consumerWaited, self.queueFull))
+            sys.stdout.flush()
+
+class BamIndex(object):
+    """
+    Reads a BAM index (.bai or .csi). Only the bin headers are walked when the index is opened - the chunk
+    lists are decoded when asked for (see chunks) - so opening even a very large index just to get the
+    read counts out of its pseudo-bins takes milliseconds.
+    """
+    def __init__(self, path):
+        with open(path,'rb') as f: data = f.read()
+        if data[:4] != 'BAI\1':
+            try: data = inflateAll(data) # .csi indexes are BGZF compressed, .bai are not.
+            except zlib.error: raise CorruptFile('The index ' + path + ' is not a BAI or CSI file.')
+        if data[:4] == 'BAI\1':
+            self.minShift, self.depth, p = 14, 5, 4
+        elif data[:4] == 'CSI\1':
+            self.minShift, self.depth, auxLength = struct.unpack_from('<iii', data, 4)
+            p = 16 + auxLength
+        else: raise CorruptFile('The index ' + path + ' is not a BAI or CSI file.')
+        self.csi = data[:4] == 'CSI\1'
+        self.data = data
+        pseudoBin = ((1 << 3*(self.depth+1)) - 1) // 7 + 1 # 37450 for a BAI. Holds the mapped/unmapped read counts.
+        self.references = []
+        for x in xrange(struct.unpack_from('<i', data, p)[0]):
+            p += 4
+            bins, mapped, unmapped = {}, None, None
+            for y in xrange(struct.unpack_from('<i', data, p)[0]):
+                if self.csi:
+                    binNumber, loffset, n_chunk = struct.unpack_from('<IQi', data, p+4)
+                    p += 16
+                else:
+                    binNumber, n_chunk = struct.unpack_from('<Ii', data, p+4)
+                    loffset = None
+                    p += 8
+                if binNumber == pseudoBin: mapped, unmapped = struct.unpack_from('<QQ', data, p+20)
+                else:                      bins[binNumber] = (p+4, n_chunk, loffset) # where its chunks are
+                p += 16*n_chunk
+            if self.csi: intervals = (p+4, 0)                                       # CSI has no linear index
+            else:
+                intervals = (p+8, struct.unpack_from('<i', data, p+4)[0])
+                p += 4 + 8*intervals[1]
+            self.references.append({'bins':bins, 'intervals':intervals, 'mapped':mapped, 'unmapped':unmapped})
+        p += 4
+        self.unplaced = struct.unpack_from('<Q', data, p)[0] if p + 8 <= len(data) else None # Reads with no coordinate.
+
+    def chunks(self, tid, binNumber):
+        ## The (start,end) virtual offsets of the chunks in a bin.
+        try: p, n_chunk, loffset = self.references[tid]['bins'][binNumber]
+        except KeyError: return []
+        values = struct.unpack_from('<%dQ' % (2*n_chunk), self.data, p)
+        return zip(values[::2], values[1::2])
+
+    def regionChunks(self, tid, beg, end):
+        ## The chunks that may hold reads overlapping [beg,end) on reference tid. For a BAI, chunks that end before
+        ## the linear index's first offset for beg can't hold anything we want, so are dropped.
+        if tid >= len(self.references): return []
+        minOffset = 0
+        p, n_intv = self.references[tid]['intervals']
+        if n_intv: minOffset = struct.unpack_from('<Q', self.data, p + 8*min(beg >> 14, n_intv-1))[0]
+        chunks = []
+        for binNumber in regionBins(beg, end, self.minShift, self.depth):
+            chunks.extend([ chunk for chunk in self.chunks(tid, binNumber) if chunk[1] > minOffset ])
+        return chunks
+
+    def readCount(self):
+        ## The exact number of reads in the BAM, or None if the index was made without the pseudo-bin counts.
+        total = self.unplaced or 0
+        for reference in self.references:
+            if reference['mapped'] is None:
+                if reference['bins']: return None
+            else: total += reference['mapped'] + reference['unmapped']
+        return total
+
+def inflateAll(data):
+    ## Decompresses a whole (multi-member) gzip/BGZF string in one go. Fine for small files like indexes.
+    output = []
+    while data:
+        inflater = zlib.decompressobj(31)
+        output.append(inflater.decompress(data))
+        data = inflater.unused_data
+    return ''.join(output)
+
+def regionBins(beg, end, minShift=14, depth=5):
+    ## Every bin that could hold a read overlapping [beg,end) - reg2bins from the SAM spec, for any CSI min_shift/depth.
+    bins, end = [], end - 1
+    shift, offset = minShift + 3*depth, 0
+    for level in xrange(depth + 1):
+        bins.extend(xrange(offset + (beg >> shift), offset + (end >> shift) + 1))
+        offset += 1 << 3*level
+        shift -= 3
+    return bins
+
+def parseRegions(regions, bedFile=None):
+    ## Turns --region strings (chr, chr:start or chr:start-end - 1-based and inclusive, like samtools) and the lines of a --regionsbed
+    ## file (0-based, end exclusive) into a list of (name, start, end) in 0-based half-open coordinates. end is None for "to the end".
+    parsed = []
+    for region in regions or []:
+        name, start, end = re.match(r'^(.+?)(?::([\d,]+)(?:-([\d,]+))?)?$', region).groups()
+        start = int(start.replace(',','')) - 1 if start else 0
+        end = int(end.replace(',','')) if end else None
+        parsed.append((name, max(0, start), end))
+    if bedFile:
+        with open(bedFile) as f:
+            for line in f:
+                if not line.strip() or line.startswith(('#','track','browser')): continue
+                columns = line.split()
+                parsed.append((columns[0], int(columns[1]), int(columns[2])))
+    return parsed
+
+def regionString(region):
+    ## The samtools-style string for a parsed region, used to record which regions an analysis covered.
+    name, start, end = region
+    if end is None: return name if start == 0 else name + ':' + str(start+1)
+    return name + ':' + str(start+1) + '-' + str(end)
+
+def findIndex(inputFile):
+    ## Returns the path of the index for a BAM, if there is one and it is not older than the BAM itself.
+    for path in (inputFile + '.bai', os.path.splitext(inputFile)[0] + '.bai', inputFile + '.csi'):
+        if os.path.isfile(path) and os.path.getmtime(path) >= os.path.getmtime(inputFile): return path
+    return None
+
+def indexReadCount(inputFile):
+    ## The exact read count from the index next to the input file, or None if there isn't a usable one.
+    indexPath = findIndex(inputFile)
+    if indexPath is None: return None
+    try: return BamIndex(indexPath).readCount()
+    except (CorruptFile, struct.error, IOError): return None
+
+def estimateReadCount(inputFile, sampleBytes=8*1024*1024):
+    ## When there is no index, count the reads in the first sampleBytes of the file and scale that up to the size
+    ## of the whole file. Small files are counted exactly. Returns None if the file can't be read.
+    sizeInBytes = os.path.getsize(inputFile)
+    if fastqCheck(inputFile):
+        with open(inputFile,'rb') as f: sample = f.read(sampleBytes)
+        lines = sum([ chunk.count('\n') for chunk in FastqDataReader(StringIO.StringIO(sample), ()).chunks() ])
+        if len(sample) < sampleBytes: return (lines + 1) // 4
+        return int( lines / 4.0 * sizeInBytes / len(sample) )
+    elif bamCheck(inputFile):
+        try: reader = BamDataReader(inputFile, ())
+        except CorruptFile: return None
+        start = reader.firstBlock
+        data, p, reads = reader.buffer, 0, 0
+        try:
+            for block in reader.stream:
+                data = data[p:] + block
+                p = 0
+                while p + 4 <= len(data):
+                    q = p + 4 + struct.unpack_from('<i', data, p)[0]
+                    if q > len(data): break
+                    reads += 1
+                    p = q
+                if reader.handle.tell() - start > sampleBytes:
+                    return int( reads * float(sizeInBytes - start) / (reader.handle.tell() - start) )
+        except CorruptFile: return None
+        return reads
+    else:
+        with open(inputFile,'rb') as f: sample = f.read(sampleBytes)
+        headerBytes = 0
+        while sample.startswith('@', headerBytes):
+            headerBytes = sample.find('\n', headerBytes) + 1
+            if headerBytes == 0: return 0
+        reads = sample.count('\n', headerBytes)
+        if len(sample) < sampleBytes: return reads + (0 if sample.endswith('\n') or len(sample) == headerBytes else 1)
+        return int( reads * float(sizeInBytes - headerBytes) / (len(sample) - headerBytes) )
+
+def countReads(inputFile):
+    ## We want to know the readcount of the BAM/SAM file to make status bars and for the total_reads column of INFO.
+    ## If the BAM has an index next to it, the index has exact mapped/unmapped counts for every reference, so we use those.
+    ## Otherwise we count the reads in the start of the file and estimate the total from that.
+    readCount = indexReadCount(inputFile) if bamCheck(inputFile) and not fastqCheck(inputFile) else None
+    if readCount is None: readCount = estimateReadCount(inputFile)
+    return readCount
+
+def quickFingerprint(inputFile, sampleBytes=1024*1024):
+    ## A cheap stand-in for the MD5 - the size, mtime, and the first and last sampleBytes of the file hashed together.
+    ## It's only used to guess which INFO row a file belongs to before we've read it. The real MD5 always has the final say.
+    stat = os.stat(inputFile)
+    md5 = hashlib.md5(str(stat.st_size) + ':' + str(int(stat.st_mtime)) + ':')
+    with open(inputFile,'rb') as f:
+        md5.update(f.read(sampleBytes))
+        if stat.st_size > sampleBytes:
+            f.seek(max(sampleBytes, stat.st_size - sampleBytes))
+            md5.update(f.read(sampleBytes))
+    return md5.hexdigest()
+
+class HashCache(object):
+    """
+    A small SQLite database (--hashcache) that remembers the MD5 of every file we have hashed, keyed on the file's
+    real path, inode, size and mtime. If any of those change the file is hashed again, otherwise we trust the MD5 from
+    last time. It is only ever an optimisation - if the cache can't be opened or written to, everything is just hashed as normal.
+    """
+    def __init__(self, path):
+        self.con = None
+        if not path: return
+        try:
+            self.con = sqlite3.connect(path, timeout=120)
+            self.con.execute('CREATE TABLE IF NOT EXISTS "HASHES" ("path" TEXT, "inode" INT, "size" INT, "mtime" TEXT, "hash" TEXT, PRIMARY KEY ("path","inode","size","mtime"))')
+            self.con.commit()
+        except sqlite3.Error: self.con = None
+
+    @staticmethod
+    def key(inputFile):
+        stat = os.stat(inputFile)
+        return (os.path.realpath(inputFile), stat.st_ino, stat.st_size, repr(stat.st_mtime))
+
+    def lookup(self, inputFile):
+        ## Returns the MD5 we stored for this exact file, or None.
+        if self.con is None: return None
+        try: result = self.con.execute('SELECT "hash" FROM "HASHES" WHERE "path"=? AND "inode"=? AND "size"=? AND "mtime"=?', self.key(inputFile)).fetchone()
+        except (sqlite3.Error, OSError): return None
+        return result[0] if result else None
+
+    def store(self, inputFile, fileHash):
+        ## Older entries for the same path are thrown away, as the file has changed since then.
+        if self.con is None: return
+        try:
+            key = self.key(inputFile)
+            self.con.execute('DELETE FROM "HASHES" WHERE "path"=?', key[:1])
+            self.con.execute('INSERT INTO "HASHES" ("path","inode","size","mtime","hash") VALUES (?,?,?,?,?)', key + (fileHash,))
+            self.con.commit()
+        except (sqlite3.Error, OSError): pass
+
+class CodeCache(object):
+    """
+    A small SQLite database (--codecache) that keeps what every subprocess would otherwise rebuild from scratch on start-up:
+    the values the stats' .before code makes (like FLAG's and TYPE's 4096-entry tables), pickled, and the compiled collect_data,
+    marshalled. Entries are keyed on the code that made them, plus this Python and this version of SeQC, so editing a .stat
+    module or SeQC itself just means a new entry. Like the HashCache, if it can't be opened or written to everything is built as normal.
+    """
+    def __init__(self, path):
+        self.con = None
+        if not path: return
+        try:
+            self.con = sqlite3.connect(path, timeout=120)
+            self.con.execute('CREATE TABLE IF NOT EXISTS "CODE" ("key" TEXT PRIMARY KEY, "data" BLOB)')
+            self.con.commit()
+            with open(SeQC,'rb') as f: self.version = sys.version + hashlib.md5(f.read()).hexdigest()
+        except (sqlite3.Error, IOError): self.con = None
+
+    def key(self, *parts):
+        if self.con is None: return None
+        return hashlib.md5('\0'.join((self.version,) + parts)).hexdigest()
+
+    def lookup(self, key):
+        ## Returns the value stored under key, or None.
+        if self.con is None: return None
+        try:
+            result = self.con.execute('SELECT "data" FROM "CODE" WHERE "key"=?', (key,)).fetchone()
+            return cPickle.loads(str(result[0])) if result else None
+        except Exception: return None # A broken entry is the same as no entry.
+
+    def store(self, key, value):
+        ## Values that can't be pickled are just not cached.
+        if self.con is None: return
+        try:
+            self.con.execute('INSERT OR REPLACE INTO "CODE" ("key","data") VALUES (?,?)', (key, sqlite3.Binary(cPickle.dumps(value, 2))))
+            self.con.commit()
+        except (sqlite3.Error, cPickle.PicklingError, TypeError): pass
+
+class HashingFile(object):
+    """
+    Wraps a file opened for reading and MD5s everything that is read out of it, so the file's checksum
+    comes for free with the analysis rather than needing a whole extra pass over the file beforehand.
+    Only sequential reads are supported - hexdigest() hashes whatever has not been read yet, then returns the MD5.
+    """
+    def __init__(self, handle):
+        self.handle = handle
+        self.md5 = hashlib.md5()
+        self.tell = handle.tell
+
+    def read(self, size=-1):
+        chunk = self.handle.read(size)
+        self.md5.update(chunk)
+        return chunk
+
+    def hexdigest(self):
+        for chunk in iter(lambda: self.read(128*self.md5.block_size), b''): pass
+        return self.md5.hexdigest()
+
+class BamDataReader(object):
+    """
+    A pure-python BGZF/BAM reader, so BAMs can be read without pysam/htspython or a samtools pipe.
+    It is given the bam_* variable names that the stats' METHODs reference, and generates a record
+    decoder at run-time that only unpacks those fields - the QNAME, CIGAR, SEQ, QUAL and tags are
+    skipped over entirely unless something asks for them. Reads are yielded as tuples in the order
+    of self.fields, which collect_data unpacks straight into local variables (see self.target).
+    Given a start/end byte range (see byteRanges) only the reads that begin in BGZF blocks within
+    that range are yielded, so one file can be split over many processes. Given regions (see
+    parseRegions) only the reads overlapping them are yielded, and if the BAM has an index only
+    the index chunks for those regions are read at all.
+    """
+    FIELDS = ('bam_tid','bam_pos','bam_mapq','bam_flag','bam_rnext','bam_pnext','bam_tlen',
+              'bam_qname','bam_cigar','bam_seq','bam_gc','bam_qual','bam_tags')
+
+    ## The fixed 32 bytes after block_size. Values we dont need are skipped with pad bytes in the struct format.
+    LAYOUT = (('bam_tid','i',4),('bam_pos','i',4),('l_read_name','B',1),('bam_mapq','B',1),('bin','H',2),('n_cigar','H',2),
+              ('bam_flag','H',2),('l_seq','i',4),('bam_rnext','i',4),('bam_pnext','i',4),('bam_tlen','i',4))
+
+    MIN_SPLIT = 32*1024*1024 # Dont bother splitting files into ranges smaller than this.
+
+    def __init__(self, inputFile, fields, start=None, end=None, threads=0, hashing=False, regions=None):
+        self.path = inputFile
+        self.threads = threads # If set, blocks are inflated on this many threads once we start reading records.
+        self.fields = [ field for field in self.FIELDS if field in fields ] + sorted([ field for field in fields if field.startswith('bam_tag_') ])
+        self.target = '(' + ','.join(self.fields) + ',)' if self.fields else 'read'
+        self.handle = HashingFile(open(inputFile,'rb')) if hashing else open(inputFile,'rb') # hashing MD5s the file as we go.
+        self.stream = self.blocks()
+        self.buffer = ''
+        self.stop = sys.maxint # Where in self.buffer our byte range ends, once we know.
+        self.ranged = end is not None
+        self.readHeader()
+        self.regions, self.chunks = None, None
+        if regions is not None: self.setRegions(regions)
+        if start is not None: self.seekRecord(start, end)
+        elif end is not None: self.stream = self.blocks(end)
+        self.records = self.makeDecoder()
+
+    def setRegions(self, regions):
+        ## Regions are kept as sorted, non-overlapping [start,end) spans per reference id. References this BAM doesn't have are ignored.
+        tids = dict( (name, tid) for tid, name in enumerate(self.references) )
+        spans = collections.defaultdict(list)
+        for name, start, end in regions:
+            if name in tids: spans[tids[name]].append((start, self.lengths[tids[name]] if end is None else end))
+        self.regions = {}
+        for tid, tidSpans in spans.items():
+            merged = []
+            for start, end in sorted(tidSpans):
+                if merged and start <= merged[-1][1]: merged[-1][1] = max(end, merged[-1][1])
+                elif start < end: merged.append([start, end])
+            self.regions[tid] = ([ start for start, end in merged ], [ end for start, end in merged ])
+        ## With an index we only read the chunks the regions need. Without one every read is checked against the regions.
+        indexPath = findIndex(self.path)
+        if indexPath is None: return
+        index = BamIndex(indexPath)
+        chunks = []
+        for tid, (starts, ends) in self.regions.items():
+            for start, end in zip(starts, ends): chunks.extend(index.regionChunks(tid, start, end))
+        self.chunks = []
+        for start, end in sorted(chunks):
+            if self.chunks and start <= self.chunks[-1][1]: self.chunks[-1][1] = max(end, self.chunks[-1][1])
+            else: self.chunks.append([start, end])
+        self.ranged = True
+
+    def inRegions(self, tid, start, end):
+        ## Does the alignment [start,end) on reference tid overlap any of our regions?
+        try: starts, ends = self.regions[tid]
+        except KeyError: return False
+        x = bisect.bisect_left(starts, end) - 1
+        return x >= 0 and ends[x] > start
+
+    def blocks(self, end=None):
+        ## Returns an iterator of the inflated contents of each BGZF block in turn. If an end offset is given,
+        ## a None comes out just before the first block that starts at or after it.
+        self.raw = self.rawBlocks(end)
+        return itertools.imap(inflateBlock, self.raw)
+
+    def rawBlocks(self, end=None):
+        ## Like blocks, but yields the compressed data of each block so they can be inflated elsewhere.
+        read, tell, unpack = self.handle.read, self.handle.tell, struct.unpack
+        while True:
+            self.blockOffset = tell()
+            if end is not None and self.blockOffset >= end:
+                end = None
+                yield None
+            head = read(12)
+            if len(head) < 12: return
+            if head[:4] != '\x1f\x8b\x08\x04': raise CorruptFile('Input is not BGZF compressed (bad block header).')
+            xlen = unpack('<H', head[10:12])[0]
+            extra = read(xlen)
+            p = 0
+            while p < xlen:                                                        # look for the BC subfield
+                subfieldLength = unpack('<H', extra[p+2:p+4])[0]
+                if extra[p:p+2] == 'BC': break
+                p += 4 + subfieldLength
+            else: raise CorruptFile('Input is gzip but not BGZF (no BSIZE in block header).')
+            blockSize = unpack('<H', extra[p+4:p+6])[0] + 1
+            compressed = read(blockSize - xlen - 20)
+            read(8)                                                                # CRC32 and ISIZE
+            yield compressed
+
+    def take(self, n):
+        while len(self.buffer) < n:
+            try: self.buffer += next(self.stream)
+            except StopIteration: raise CorruptFile('BAM file is truncated.')
+        data, self.buffer = self.buffer[:n], self.buffer[n:]
+        return data
+
+    def readHeader(self):
+        if self.take(4) != 'BAM\1': raise CorruptFile('Input is BGZF compressed, but is not a BAM file.')
+        headerText = self.take(struct.unpack('<i', self.take(4))[0]).rstrip('\0')
+        self.references, self.lengths = [], []
+        for x in xrange(struct.unpack('<i', self.take(4))[0]):
+            self.references.append(self.take(struct.unpack('<i', self.take(4))[0])[:-1])
+            self.lengths.append(struct.unpack('<i', self.take(4))[0])
+        self.header = parseSamHeader(headerText, self.references, self.lengths)
+        self.firstBlock = self.blockOffset if self.buffer else self.handle.tell() # Block the first read starts in.
+
+    def isRecord(self, data, p, chain=3):
+        ## Does a valid-looking record start at data[p] (followed by more valid-looking records)?
+        ## This is only used to find the first read in a byte range, as BGZF blocks don't start on read boundaries.
+        references = len(self.references)
+        while chain and p + 36 <= len(data):
+            size,tid,pos,l_read_name,mapq,bin,n_cigar,flag,l_seq,mtid,mpos,tlen = struct.unpack_from('<iiiBBHHHiiii', data, p)
+            if not (-1 <= tid < references and -1 <= mtid < references and pos >= -1 and mpos >= -1 and l_read_name > 0 and l_seq >= 0): return False
+            if size < 32 + l_read_name + 4*n_cigar + (l_seq+1)//2 + l_seq: return False
+            if p + 36 + l_read_name <= len(data) and not re.match(r'[!-~]*\0$', data[p+36:p+36+l_read_name]): return False
+            p += 4 + size
+            chain -= 1
+        return True
+
+    def seekChunk(self, start, end):
+        ## Start reading at the read at virtual offset start, and stop at virtual offset end, as given by an index chunk.
+        ## Returns how far into its block the end is, as the stream only knows which block the end is in.
+        self.handle.seek(start >> 16)
+        self.stream = self.blocks(end >> 16)
+        first = next(self.stream, '')
+        if first is None:   # The chunk starts and ends in the same block.
+            first = next(self.stream, '')
+            self.buffer, self.stop = first[start & 0xffff:], (end & 0xffff) - (start & 0xffff)
+        else:
+            self.buffer, self.stop = first[start & 0xffff:], sys.maxint
+        return end & 0xffff
+
+    def seekRecord(self, start, end):
+        ## Start reading from the first read that begins in a block at or after the start offset (and before end).
+        self.handle.seek(start)
+        self.stream = self.blocks(end)
+        blocks = list(itertools.islice(self.stream, 4))
+        for x in itertools.count():
+            if x >= len(blocks) or blocks[x] is None: # No read starts inside our range at all.
+                self.buffer, self.stop = '', 0
+                return
+            while len(blocks) < x + 4:                # Keep a few blocks ahead to check the reads following our guess.
+                more = next(self.stream, False)
+                if more is False: break
+                blocks.append(more)
+            before = sum( len(block) for block in blocks[:x] )
+            data = ''.join( block for block in blocks if block is not None )
+            for p in xrange(before, before + len(blocks[x])):
+                if self.isRecord(data, p):
+                    if None in blocks: self.stop = sum( len(block) for block in blocks[:blocks.index(None)] ) - p
+                    self.buffer = data[p:]
+                    return
+
+    def makeDecoder(self):
+        ## Work out what we need out of the fixed part of the record, including the lengths required to find
+        ## the start of any variable-length field we want:
+        wanted = set(self.fields)
+        if wanted & set(['bam_qname','bam_cigar','bam_seq','bam_gc','bam_qual','bam_tags']): wanted.add('l_read_name')
+        if wanted & set(['bam_cigar','bam_seq','bam_gc','bam_qual','bam_tags']):             wanted.add('n_cigar')
+        if wanted & set(['bam_seq','bam_gc','bam_qual','bam_tags']):                         wanted.add('l_seq')
+        if any(field.startswith('bam_tag_') for field in wanted): wanted.update(['l_read_name','n_cigar','l_seq']) # TAG('XX') fields
+        if self.regions is not None: wanted.update(['bam_tid','bam_pos','l_read_name','n_cigar']) # To check reads against the regions.
+        unpackFormat, unpackNames = '<', []
+        for name,fieldType,size in self.LAYOUT:
+            if name in wanted: unpackFormat += fieldType ; unpackNames.append(name)
+            else:              unpackFormat += str(size) + 'x'
+        unpackFormat = re.sub(r'[\dx]+$', '', unpackFormat) # No point skipping bytes at the end.
+
+        code  = 'def records(data, stream, stop, tail=0):\n'
+        code += '    unpack = struct.Struct("' + unpackFormat + '").unpack_from\n'
+        code += '    unpackSize = struct.Struct("<i").unpack_from\n'
+        code += '    p = 0\n'
+        code += '    while True:\n'
+        code += '        end = len(data)\n'
+        code += '        while p + 4 <= end:\n'
+        if self.ranged:
+            code += '            if p >= stop:\n'
+            code += '                if hasattr(stream, "close"): stream.close()\n' # Lets an InflatePipeline know we are done with it.
+            code += '                return\n'
+        ## Decoding one record at data[p] (which ends at q) is the same whether we are streaming or given the offsets:
+        decode = []
+        if unpackNames:
+            decode.append(','.join(unpackNames) + ', = unpack(data, p+4)')
+        if 'l_read_name' in wanted:
+            decode.append('cigar_start = p + 36 + l_read_name')
+        if self.regions is not None:
+            decode.append('if not inRegions(bam_tid, bam_pos, bam_pos + max(1, bamRefLength(data, cigar_start, n_cigar))):')
+            decode.append('    p = q')
+            decode.append('    continue')
+        if 'bam_qname' in wanted:
+            decode.append('bam_qname = data[p+36:cigar_start-1]')
+        if 'bam_cigar' in wanted:
+            decode.append('bam_cigar = bamCigar(data, cigar_start, n_cigar)')
+        if 'l_seq' in wanted:
+            decode.append('seq_start = cigar_start + 4*n_cigar')
+            decode.append('qual_start = seq_start + (l_seq+1)//2')
+        if 'bam_seq' in wanted:
+            decode.append('bam_seq = bamSeq(data, seq_start, l_seq)')
+        if 'bam_gc' in wanted:
+            decode.append('bam_gc = bamGC(data, seq_start, l_seq)')
+        if 'bam_qual' in wanted:
+            decode.append('bam_qual = bamQual(data, qual_start, l_seq)')
+        if 'bam_tags' in wanted:
+            decode.append('bam_tags = bamTags(data, qual_start + l_seq, q)')
+        for field in self.fields:
+            if field.startswith('bam_tag_'): decode.append(field + ' = bamTag(data, qual_start + l_seq, q, "' + field[8:] + '")')
+        decode.append('yield (' + ''.join([ field + ',' for field in self.fields ]) + ')')
+
+        code += '            q = p + 4 + unpackSize(data, p)[0]\n'
+        code += '            if q > end: break\n'
+        code += ''.join([ '            ' + line + '\n' for line in decode ])
+        code += '            p = q\n'
+        code += '        more = list(itertools.islice(stream, 16))\n'   # Refill with a few blocks at a time, not one.
+        code += '        if not more:\n'
+        code += '            if p != end: raise CorruptFile("BAM file is truncated.")\n'
+        code += '            return\n'
+        if self.ranged:                                            # A None in the stream marks the end of our byte range.
+            code += '        if None in more:\n'
+            code += '            stop = end + sum(map(len, more[:more.index(None)])) + tail\n'
+            code += '            more.remove(None)\n'
+            code += '        stop -= p\n'
+        code += '        data = data[p:] + "".join(more)\n'
+        code += '        p = 0\n'
+        ## The same decoder over a list of record offsets, for reads that the --vector engine has already found (see batches):
+        code += 'def recordsAt(data, offsets):\n'
+        code += '    unpack = struct.Struct("' + unpackFormat + '").unpack_from\n'
+        code += '    unpackSize = struct.Struct("<i").unpack_from\n'
+        code += '    for p in offsets:\n'
+        code += '        q = p + 4 + unpackSize(data, p)[0]\n'
+        code += ''.join([ '        ' + line + '\n' for line in decode ])
+        namespace = {'struct':struct, 'itertools':itertools, 'CorruptFile':CorruptFile,
+                     'bamCigar':bamCigar, 'bamSeq':bamSeq, 'bamGC':bamGC, 'bamQual':bamQual, 'bamTags':bamTags, 'bamTag':bamTag,
+                     'bamRefLength':bamRefLength, 'inRegions':self.inRegions}
+        exec(code, namespace)
+        self.code = code
+        self.recordsAt = namespace['recordsAt']
+        return namespace['records']
+
+    def __iter__(self):
+        if self.chunks is not None: return self.chunkRecords()
+        data, self.buffer = self.buffer, ''
+        if self.threads:
+            ## Hand whatever blocks the header/seeking hasn't already inflated over to the threads:
+            self.stream = iter(InflatePipeline(self.raw, self.threads))
+        return self.records(data, self.stream, self.stop)
+
+    def batches(self, size=65536):
+        ## For the --vector engine. Yields (data, offsets) - a string holding whole records, and the offsets of (at least) size of
+        ## them in it, or whatever is left - so the fixed part of every record can be pulled out into NumPy columns at once (see bamColumns).
+        data, self.buffer = self.buffer, ''
+        stream, stop = self.stream, self.stop
+        if self.threads: stream = iter(InflatePipeline(self.raw, self.threads))
+        unpackSize = struct.Struct('<i').unpack_from
+        p, offsets = 0, []
+        while True:
+            end = len(data)
+            while p + 4 <= end and p < stop:
+                q = p + 4 + unpackSize(data, p)[0]
+                if q > end: break
+                offsets.append(p)
+                p = q
+            if len(offsets) >= size or (offsets and p >= stop):
+                yield data, offsets
+                data, stop, p, offsets = data[p:], stop - p, 0, []
+                end = len(data)
+            if p >= stop:
+                if hasattr(stream, 'close'): stream.close()
+                return
+            more = list(itertools.islice(stream, 64))
+            if not more:
+                if p != end: raise CorruptFile('BAM file is truncated.')
+                if offsets: yield data, offsets
+                return
+            if None in more:
+                stop = end + sum(map(len, more[:more.index(None)]))
+                more.remove(None)
+            data += ''.join(more)
+
+    def chunkRecords(self):
+        for start, end in self.chunks:
+            tail = self.seekChunk(start, end)
+            for read in self.records(self.buffer, self.stream, self.stop, tail): yield read
+
+    def byteRanges(self, n):
+        ## Splits the file into (up to) n byte ranges of roughly the same size, each starting on a BGZF block.
+        ## The first range has no start (start reading after the header), the last range has no end.
+        size = os.path.getsize(self.path)
+        n = max(1, min(n, size // self.MIN_SPLIT))
+        starts = []
+        with open(self.path,'rb') as f:
+            for x in range(1,n):
+                offset = self.nextBlock(f, size*x//n)
+                if offset is not None and offset > self.firstBlock and offset not in starts: starts.append(offset)
+        return zip([None]+starts, starts+[None])
+
+    def sampleRanges(self, fraction, chunkSize=1024*1024):
+        ## For --sampleblocks. Cuts the file into chunkSize pieces and returns the byte ranges (as in byteRanges) of a random
+        ## fraction of them, in file order, along with the fraction of the file's record bytes those ranges actually cover.
+        size = os.path.getsize(self.path)
+        pieces = max(1, size // chunkSize)
+        ranges, covered = [], 0
+        with open(self.path,'rb') as f:
+            for x in sorted(random.sample(xrange(pieces), max(1, int(round(pieces * fraction))))):
+                start = self.nextBlock(f, size*x//pieces) if x else self.firstBlock
+                end = self.nextBlock(f, size*(x+1)//pieces) if x+1 < pieces else None
+                if start is None or start >= (end or size): continue     # No block starts in this piece.
+                if end is not None and end <= self.firstBlock: continue   # The piece is all header.
+                start = max(start, self.firstBlock)
+                if ranges and ranges[-1][1] == start: start = ranges.pop()[0] # Neighbouring pieces become one range.
+                ranges.append((start, end))
+        for start, end in ranges: covered += (end or size) - start
+        ranges = [ (None if start == self.firstBlock else start, end) for start, end in ranges ]
+        return ranges, covered / float(max(1, size - self.firstBlock))
+
+    @staticmethod
+    def nextBlock(f, offset):
+        ## Returns the offset of the first BGZF block header at or after offset. A candidate header only counts
+        ## if another block header (or the end of the file) is found exactly where its BSIZE says it ends.
+        f.seek(offset)
+        data = f.read(1024*1024)
+        p = data.find('\x1f\x8b\x08\x04')
+        while p != -1:
+            if data[p+12:p+16] == 'BC\x02\x00' and len(data) >= p+18:
+                nextOffset = offset + p + struct.unpack('<H', data[p+16:p+18])[0] + 1
+                f.seek(nextOffset)
+                nextHead = f.read(4)
+                if nextHead == '\x1f\x8b\x08\x04' or nextHead == '': return offset + p
+            p = data.find('\x1f\x8b\x08\x04', p+1)
+        return None
+
+## The --vector engine's view of the fixed 36 bytes at the start of every BAM record:
+if numpyInstalled:
+    bamRecordType = numpy.dtype([('block_size','<i4'),('bam_tid','<i4'),('bam_pos','<i4'),('l_read_name','u1'),('bam_mapq','u1'),('bin','<u2'),
+                                 ('n_cigar','<u2'),('bam_flag','<u2'),('bam_l_seq','<i4'),('bam_rnext','<i4'),('bam_pnext','<i4'),('bam_tlen','<i4')])
+    bamGCCounts = numpy.frombuffer(bamGCTable, numpy.uint8)
+    bamATCounts = numpy.frombuffer(bamATTable, numpy.uint8)
+
+def bamColumns(data, offsets):
+    ## Turns a batch from BamDataReader.batches into a dictionary of NumPy columns - bam_tid, bam_pos, bam_mapq, bam_flag,
+    ## bam_l_seq, bam_rnext, bam_pnext and bam_tlen - one value per read. This is what stats' VECTOR code runs on.
+    ## The whole batch (bam_data) and where each read's packed sequence starts in it (bam_seq_start) are there too, for bamGCVector.
+    raw = numpy.frombuffer(data, numpy.uint8)
+    offsets = numpy.asarray(offsets)
+    fixed = raw[offsets[:,None] + numpy.arange(36)].view(bamRecordType).ravel()
+    columns = dict( (name, fixed[name]) for name in ('bam_tid','bam_pos','bam_mapq','bam_flag','bam_l_seq','bam_rnext','bam_pnext','bam_tlen') )
+    columns['bam_data'] = raw
+    columns['bam_seq_start'] = offsets + 36 + fixed['l_read_name'] + 4*fixed['n_cigar'].astype(numpy.int64)
+    return columns
+
+def bamGCVector(raw, seqStart, l_seq):
+    ## bamGC for a whole batch: every packed sequence byte of every read is looked up in the same tables at once,
+    ## and numpy.bincount adds them up per read.
+    length = (l_seq.astype(numpy.int64) + 1) // 2
+    reads = numpy.repeat(numpy.arange(len(length)), length)
+    positions = numpy.arange(length.sum()) + numpy.repeat(seqStart - (numpy.cumsum(length) - length), length)
+    packed = raw[positions]
+    cg = numpy.bincount(reads, bamGCCounts[packed], len(length)).astype(numpy.int64)
+    at = numpy.bincount(reads, bamATCounts[packed], len(length)).astype(numpy.int64)
+    return numpy.where(cg + at > 0, (cg*100) // numpy.maximum(cg + at, 1), None)
+
+class PackedCounter(object):
+    ## Counts one --vector group - the vectorised version of group[(STAT1,STAT2,)] += 1. Every value a stat produces is given a small
+    ## integer code the first time it is seen, and a read's codes are packed into one integer key, so a whole batch is counted with
+    ## numpy.bincount (or numpy.unique when the keys get too big for that). Codes are only turned back into values by items(), when
+    ## the table is built. If the codes stop fitting into one 64-bit key, the keys become tuples of codes instead.
+    DENSE = 1 << 20 # Largest key range counted with bincount.
+    def __init__(self, width):
+        self.values = [ [] for x in range(width) ] # code -> value, per stat
+        self.codes  = [ {} for x in range(width) ] # value -> code, per stat
+        self.bits   = [ 1 ] * width                # bits each stat has in the packed key
+        self.counts = collections.defaultdict(int) # packed key (or tuple of codes) -> reads
+        self.packed = True
+
+    def add(self, columns, length):
+        codes = []
+        for x, column in enumerate(columns):
+            unique, inverse = numpy.unique(numpy.broadcast_to(numpy.asarray(column), (length,)), return_inverse=True)
+            known, values = self.codes[x], self.values[x]
+            lookup = []
+            for value in unique.tolist():
+                if value not in known:
+                    known[value] = len(values)
+                    values.append(value)
+                lookup.append(known[value])
+            codes.append(numpy.array(lookup, numpy.int64)[inverse])
+        if self.packed:
+            bits = [ max(old, len(values).bit_length()) for old, values in zip(self.bits, self.values) ]
+            if bits != self.bits: self.repack(bits)
+        if self.packed:
+            key = numpy.zeros(length, numpy.int64)
+            for code, width in zip(codes, self.bits): key = (key << width) | code
+            if 1 << sum(self.bits) <= self.DENSE:
+                counts = numpy.bincount(key)
+                keys = numpy.flatnonzero(counts)
+                counts = counts[keys]
+            else: keys, counts = numpy.unique(key, return_counts=True)
+            keys = keys.tolist()
+        else:
+            keys, counts = numpy.unique(numpy.column_stack(codes), axis=0, return_counts=True)
+            keys = [ tuple(key) for key in keys.tolist() ]
+        total = self.counts
+        for key, count in zip(keys, counts.tolist()): total[key] += count
+
+    def unpack(self, key, bits):
+        row = []
+        for width in reversed(bits):
+            row.append(key & ((1 << width) - 1))
+            key >>= width
+        return tuple(reversed(row))
+
+    def repack(self, bits):
+        ## A stat has seen more values than its bits can hold - re-key everything counted so far with the new widths.
+        old, self.counts = self.counts, collections.defaultdict(int)
+        if sum(bits) > 62: self.packed = False
+        for key, count in old.iteritems():
+            codes = self.unpack(key, self.bits)
+            if self.packed:
+                key = 0
+                for code, width in zip(codes, bits): key = (key << width) | code
+            else: key = codes
+            self.counts[key] += count
+        self.bits = bits
+
+    def items(self):
+        for key, count in self.counts.iteritems():
+            codes = self.unpack(key, self.bits) if self.packed else key
+            yield tuple([ values[code] for values, code in zip(self.values, codes) ]), count
+
+DOMAIN_CELLS = 1 << 16 # Largest flat list a DOMAIN group is counted in. Indexing a list is about twice as fast as hashing a tuple into a dictionary.
+def foldDomainCounts(cells, counts, domains):
+    ## Moves what collect_data counted in a DOMAIN group's flat list into the group's dictionary, and zeroes the list.
+    ## A cell's number is the group's values, each minus its domain's low value, as the digits of a mixed-radix number.
+    for cell in itertools.compress(xrange(len(cells)), cells):
+        count, cells[cell], key = cells[cell], 0, []
+        for low, high in reversed(domains):
+            cell, digit = divmod(cell, high - low + 1)
+            key.append(low + digit)
+        counts[tuple(reversed(key))] += count
+
+def domainCounter(group_idx, group, domains):
+    ## The collect_data code that counts a group into a flat list instead of its dictionary. Any read with a value outside
+    ## of its stat's domain (or None) is counted in the dictionary as usual. Returns the list's size and the code, or None, None.
+    inRange, index, offset, cells = [], [], 0, 1
+    for stat, (low, high) in reversed(zip(group, domains)):
+        inRange.insert(0, '%d <= %s <= %d' % (low, stat, high))
+        index.insert(0, stat if cells == 1 else '%s*%d' % (stat, cells))
+        offset += low * cells
+        cells *= high - low + 1
+    if cells > DOMAIN_CELLS: return None, None
+    index = ' + '.join(index) + (' - %d' % offset if offset > 0 else ' + %d' % -offset if offset < 0 else '')
+    return cells, 'if %s: cells%d[%s] += 1\nelse: group%d[(%s,)] += 1' % (' and '.join(inRange), group_idx, index, group_idx, ','.join(group))
+
+class CountSpiller(object):
+    ## Keeps the counts of linked groups under --memorylimit. Groups like (RNAME,POS) or anything with QNAME can have a key for
+    ## almost every read, so when their dictionaries get too big the biggest are sorted by key, written to a temporary run file,
+    ## and emptied. rows() then merges a group's runs with whatever is still in memory, in key order, summing keys that turn up
+    ## in more than one run - so the table can be streamed into the database without ever being in memory all at once.
+    CHUNK = 10000 # (key, count) pairs pickled together in a run file.
+    def __init__(self, limit):
+        self.limit = limit                        # bytes, or None for no limit
+        self.runs  = collections.defaultdict(list) # group_idx -> run files, each sorted by key
+        self.paths = []                            # every run file this process has to delete
+
+    def size(self, counts):
+        ## Rough size of a dictionary of counts in bytes, from the size of a few of its keys.
+        sample = list(itertools.islice(counts.iteritems(), 32))
+        if not sample: return 0
+        each = sum([ sys.getsizeof(key) + sum([ sys.getsizeof(value) for value in key ]) + sys.getsizeof(count) for key, count in sample ]) / len(sample)
+        return sys.getsizeof(counts) + len(counts) * each
+
+    def check(self, data, busy=()):
+        ## busy groups are being read from, so they can't be spilled right now.
+        if self.limit is None: return
+        sizes = sorted([ (self.size(counts), group_idx) for group_idx, counts in enumerate(data) if group_idx not in busy ], reverse=True)
+        total = sum([ size for size, group_idx in sizes ])
+        if total <= self.limit: return
+        ## Spill the biggest groups until we're down to half the limit, so we aren't back here again a moment later.
+        for size, group_idx in sizes:
+            if total <= self.limit / 2 or size == 0: break
+            self.spill(group_idx, data[group_idx])
+            total -= size
+
+    def spill(self, group_idx, counts):
+        handle, path = tempfile.mkstemp(prefix='SeQC_', suffix='.run')
+        self.paths.append(path)
+        with os.fdopen(handle, 'wb') as f:
+            keys = sorted(counts)
+            for start in xrange(0, len(keys), self.CHUNK):
+                cPickle.dump([ (key, counts[key]) for key in keys[start:start+self.CHUNK] ], f, 2)
+        self.runs[group_idx].append(path)
+        counts.clear()
+
+    def take(self):
+        ## For --split: a worker hands its run files to the parent, which merges them along with its own.
+        runs, self.runs, self.paths = dict(self.runs), collections.defaultdict(list), []
+        return runs
+
+    def adopt(self, runs):
+        for group_idx, paths in runs.iteritems():
+            self.runs[group_idx].extend(paths)
+            self.paths.extend(paths)
+
+    def readRun(self, path):
+        with open(path, 'rb') as f:
+            while True:
+                try: chunk = cPickle.load(f)
+                except EOFError: return
+                for item in chunk: yield item
+
+    def rows(self, group_idx, counts, keep=False):
+        ## keep leaves the group's runs to be read again.
+        runs = self.runs.get(group_idx, []) if keep else self.runs.pop(group_idx, [])
+        if not runs:
+            for item in counts.iteritems(): yield item
+            return
+        merged = heapq.merge(*([ self.readRun(path) for path in runs ] + [ iter(sorted(counts.iteritems())) ]))
+        for key, items in itertools.groupby(merged, lambda item: item[0]):
+            yield key, sum([ count for key, count in items ])
+
+    def close(self):
+        for path in self.paths:
+            try: os.remove(path)
+            except OSError: pass
+        self.paths = []
+
+class ColumnCache(object):
+    """
+    The --columncache directory, which keeps the value every linked stat made for every read of a file, so that new groups of
+    those stats can be counted without reading the file again. Each column is two files named after the file's MD5, the stat,
+    the stat's MD5 and the reader (RNAME is a number from the BAM reader, but a name from the SAM reader): a .npy file of one
+    int32 code per read, in file order, and a .values file with the pickled list of values the codes stand for.
+    Columns are only written after a whole file has been read in order, so they always line up read for read.
+    While a file is read the codes go out to a temporary file every FLUSH reads, so what is kept in memory is each stat's
+    values. A stat that makes more than MAX_VALUES different values in a file (like QNAME, or POS on a big file) is dropped
+    instead, and a .many file is left so it isn't recorded for that file again.
+    """
+    CHUNK = 1 << 22      # Reads counted at a time when counting from columns.
+    FLUSH = 1 << 14      # Reads between writing out the recorded codes.
+    MAX_VALUES = 1 << 16 # Most different values a stat can make in a file and still get a column.
+    def __init__(self, path, file_hash, fileReader, statHashes):
+        self.path, self.file_hash, self.fileReader, self.statHashes = path, file_hash, fileReader, statHashes
+        self.codes, self.columns = {}, {} # stat -> { value: code }, stat -> array of codes, for the columns being recorded.
+        self.files = {}                   # stat -> (open temporary file, its path), for the codes written out so far.
+
+    def name(self, stat):
+        return os.path.join(self.path, '_'.join([ self.file_hash, stat, self.statHashes[stat], self.fileReader ]))
+
+    def load(self, stat):
+        with open(self.name(stat) + '.values', 'rb') as f: values = cPickle.load(f)
+        return numpy.load(self.name(stat) + '.npy', mmap_mode='r'), values
+
+    def usable(self, stats):
+        ## True if every stat has a column, and they all have the same number of reads.
+        try: lengths = set([ len(self.load(stat)[0]) for stat in stats ])
+        except Exception: return False
+        return len(lengths) == 1
+
+    def record(self, stats):
+        ## Returns the stats that will be recorded - none at all if the directory can't be written to.
+        try:
+            if not os.path.isdir(self.path): os.makedirs(self.path)
+            stats = [ stat for stat in stats if not os.path.exists(self.name(stat) + '.many') ]
+            for stat in stats:
+                handle, raw = tempfile.mkstemp(dir=self.path)
+                self.files[stat] = (os.fdopen(handle, 'wb'), raw)
+                self.codes[stat], self.columns[stat] = {}, array.array('i')
+        except (OSError, IOError):
+            self.discard()
+            return []
+        atexit.register(self.discard)
+        return stats
+
+    def drop(self, stat):
+        ## Stops keeping a column. collect_data still hands it codes, which are just thrown away at each flush.
+        handle, raw = self.files.pop(stat)
+        handle.close()
+        try: os.remove(raw)
+        except OSError: pass
+
+    def flush(self):
+        ## Writes out the codes recorded so far. The arrays are emptied in place, as collect_data holds on to their append methods.
+        for stat, column in self.columns.iteritems():
+            if stat in self.files and len(self.codes[stat]) > self.MAX_VALUES:
+                self.drop(stat)
+                try: open(self.name(stat) + '.many', 'wb').close()
+                except IOError: pass
+            if stat in self.files:
+                try: column.tofile(self.files[stat][0])
+                except IOError: self.drop(stat)
+            if stat not in self.files: self.codes[stat].clear()
+            del column[:]
+
+    def save(self):
+        ## Like the other caches, if the columns can't be written the analysis itself still goes ahead as normal.
+        self.flush()
+        try:
+            for stat, (handle, raw) in self.files.items():
+                handle.close()
+                values = [None] * len(self.codes[stat])
+                for value, code in self.codes[stat].iteritems(): values[code] = value
+                ## Both files are written under temporary names first, so a column is either all there or not there at all.
+                handle, npy = tempfile.mkstemp(dir=self.path)
+                with os.fdopen(handle, 'wb') as f:
+                    numpy.lib.format.write_array_header_1_0(f, {'descr': numpy.dtype(numpy.int32).str, 'fortran_order': False, 'shape': (os.path.getsize(raw) // 4,)})
+                    with open(raw, 'rb') as codes: shutil.copyfileobj(codes, f, 1 << 20)
+                handle, pickled = tempfile.mkstemp(dir=self.path)
+                with os.fdopen(handle, 'wb') as f: cPickle.dump(values, f, 2)
+                os.rename(npy, self.name(stat) + '.npy')
+                os.rename(pickled, self.name(stat) + '.values')
+        except (OSError, IOError, cPickle.PicklingError): pass
+        self.discard()
+
+    def discard(self):
+        ## Removes the temporary files of the codes, whether or not they made it into columns.
+        for handle, raw in self.files.values():
+            handle.close()
+            try: os.remove(raw)
+            except OSError: pass
+        self.files = {}
+
+    def count(self, group, counts, ping=None):
+        ## Counts a group straight from its stats' columns - the codes of each read are packed into one integer key per read.
+        columns = [ self.load(stat) for stat in group ]
+        radixes = [ max(1, len(values)) for codes, values in columns ]
+        packed = reduce(lambda x, y: x * y, radixes, 1) < 1 << 62
+        reads = len(columns[0][0])
+        for start in xrange(0, reads, self.CHUNK):
+            codes = [ numpy.asarray(column[start:start+self.CHUNK], numpy.int64) for column, values in columns ]
+            if packed:
+                key = codes[0]
+                for code, radix in zip(codes[1:], radixes[1:]): key = key * radix + code
+                keys, hits = numpy.unique(key, return_counts=True)
+                for key, hit in zip(keys.tolist(), hits.tolist()):
+                    row = []
+                    for radix in reversed(radixes):
+                        key, code = divmod(key, radix)
+                        row.append(code)
+                    counts[tuple([ values[code] for (column, values), code in zip(columns, reversed(row)) ])] += hit
+            else:
+                keys, hits = numpy.unique(numpy.column_stack(codes), axis=0, return_counts=True)
+                for key, hit in zip(keys.tolist(), hits.tolist()):
+                    counts[tuple([ values[code] for (column, values), code in zip(columns, key) ])] += hit
+            if ping: ping(start)
+
+class WorkerPool(object):
+    """
+    The --pool of worker processes. The workers are forked from the parent once, straight after the stats have been loaded
+    and checked, and stay alive for the whole run, taking files off a queue. Each file is then analysed in a fork of its
+    worker, which picks up exactly where a "python SeQC.js.py --BAM ..." subprocess would be after loading the stats, so no
+    file has to wait for bash, python and every .stat file to start up again - and nothing one file does (its globals,
+    its exit(), a crash) reaches the next. A file's process reports to the supervisor on a named pipe, just like it would
+    on its stdout, and the pipe closes when it finishes, just like a subprocess' stdout.
+    """
+    class Job(object):
+        def __init__(self, stdout): self.stdout = stdout # All the supervisor needs from a subprocess.Popen.
+
+    def __init__(self, workers):
+        self.parent, self.pids, self.directory, self.started = os.getpid(), [], None, 0
+        self.jobs = multiprocessing.Queue()
+        self.argv = None
+        sys.stdout.flush(); sys.stderr.flush() # Or anything still buffered would be printed again by every fork.
+        for x in range(max(1, workers)):
+            pid = os.fork()
+            if pid == 0:
+                self.argv = self.work()
+                return
+            self.pids.append(pid)
+
+    def work(self):
+        ## A worker. Only ever returns in the fork that analyses a file, with that file's command line arguments.
+        try:
+            while True:
+                try: job = self.jobs.get(timeout=1)
+                except Queue.Empty:
+                    if os.getppid() != self.parent: os._exit(0) # The parent stopped early, so no jobs are coming.
+                    continue
+                if job is None: os._exit(0)
+                fifo, argv, readFrom = job
+                out = os.open(fifo, os.O_WRONLY)
+                os.unlink(fifo)
+                pid = os.fork()
+                if pid == 0:
+                    os.dup2(out, 1); os.close(out)
+                    devnull = os.open(os.devnull, os.O_WRONLY)
+                    os.dup2(devnull, 2); os.close(devnull)
+                    if readFrom is not None: # What would have been piped into the subprocess by bash (samtools view).
+                        reader = subprocess.Popen(readFrom, stdout=subprocess.PIPE, shell=True, executable='/bin/bash')
+                        os.dup2(reader.stdout.fileno(), 0)
+                    random.seed() # Otherwise every file would be --sample'd with the same random numbers.
+                    return argv
+                os.close(out)
+                os.waitpid(pid, 0)
+        except KeyboardInterrupt: os._exit(1)
+
+    def start(self, argv, readFrom=None):
+        ## Queues a file's arguments for the next free worker, and returns what the supervisor watches.
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix='SeQC_pool_')
+            atexit.register(shutil.rmtree, self.directory, True) # Even if we're stopped with a Ctrl+C.
+        self.started += 1
+        fifo = os.path.join(self.directory, str(self.started))
+        os.mkfifo(fifo)
+        stdout = os.fdopen(os.open(fifo, os.O_RDONLY | os.O_NONBLOCK), 'rb')
+        self.jobs.put((fifo, argv, readFrom))
+        return self.Job(stdout)
+
+    def close(self):
+        for pid in self.pids: self.jobs.put(None)
+        for pid in self.pids: os.waitpid(pid, 0)
+
+class FileBatch(object):
+    """
+    A --batch of small files, given to one subprocess as several --input files. The subprocess leads the batch: it analyses
+    the files one after the other, each in a fork of itself that carries on as that file's normal subprocess, and keeps
+    the only database connection of the whole batch. In a file's fork this object stands in for the connection and the
+    cursor - the INFO lookups (SELECTs) are answered by the leader straight away, but everything the file would write is
+    sent to the leader and held there, until every file is done and it is all written in a single transaction. A file
+    whose process doesn't finish doesn't get any of its writes in. Everything a batch writes is held in memory until the
+    end, so batches are for small files.
+    """
+    def __init__(self, inputFiles, connect, postgres, debug=False):
+        self.connect, self.postgres, self.debug, self.con, self.rows = connect, postgres, debug, None, []
+        logs = []
+        for inputFile in inputFiles:
+            sys.stdout.write('> ' + inputFile + '\n'); sys.stdout.flush()
+            toLeader, fromFile = os.pipe()
+            toFile, fromLeader = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(toLeader); os.close(fromLeader)
+                self.requests, self.replies = os.fdopen(fromFile, 'wb'), os.fdopen(toFile, 'rb')
+                self.inputFile = inputFile
+                random.seed()
+                return
+            os.close(fromFile); os.close(toFile)
+            with os.fdopen(toLeader, 'rb') as requests:
+                with os.fdopen(fromLeader, 'wb') as replies: log = self.serve(requests, replies)
+            os.waitpid(pid, 0)
+            if log: logs.append(log)
+        self.write(logs)
+
+    def serve(self, requests, replies):
+        ## The leader's side of a file's process. Returns what it wants written, or None if it stopped before it was done.
+        log = []
+        while True:
+            try: request = cPickle.load(requests)
+            except EOFError: return None
+            if request[0] == 'done': return log
+            elif request[0] == 'query':
+                if self.con is None: self.con = self.connect()
+                try:
+                    cur = self.con.cursor()
+                    cur.execute(request[1], request[2])
+                    reply = cur.fetchall()
+                    cur.close()
+                    self.con.commit() # So no read is left holding a lock while the next file is analysed.
+                except Exception, e:
+                    self.con.rollback()
+                    reply = e
+                cPickle.dump(reply, replies, 2); replies.flush()
+            else: log.append(request)
+
+    def write(self, logs):
+        sys.stdout.write('@\n'); sys.stdout.flush()
+        if logs:
+            if self.con is None: self.con = self.connect()
+            cur = self.con.cursor()
+            try:
+                if not self.postgres: cur.execute('BEGIN EXCLUSIVE') # The leader's SQLite connection has no implicit transactions (isolation_level None)
+                for log in logs:                                      # so that CREATE TABLE doesn't commit half a batch.
+                    for request in log:
+                        if request[0] == 'execute':       cur.execute(request[1], request[2])
+                        elif request[0] == 'executemany': cur.executemany(request[1], request[2])
+                        elif request[0] == 'copy':        cur.copy_from(StringIO.StringIO(request[1]), request[2])
+                if self.postgres: self.con.commit()
+                else:             cur.execute('COMMIT')
+            except Exception, e:
+                if self.debug: print '\nERROR: Writing the batch to the database failed, so none of its files were written. The exact error was:\n' + str(e)
+                else: print '?'
+                exit()
+        if self.con is not None: self.con.close()
+        sys.stdout.write('!\n'); sys.stdout.flush()
+        exit()
+
+    ## In a file's process, the batch is its connection and its cursor:
+    def send(self, request):
+        cPickle.dump(request, self.requests, 2); self.requests.flush()
+    def cursor(self): return self
+    def execute(self, sql, parameters=()):
+        if not sql.lstrip().upper().startswith('SELECT'): return self.send(('execute', sql, tuple(parameters)))
+        self.send(('query', sql, tuple(parameters)))
+        reply = cPickle.load(self.replies)
+        if isinstance(reply, Exception): raise reply
+        self.rows = reply
+    def executemany(self, sql, rows): self.send(('executemany', sql, [ tuple(row) for row in rows ]))
+    def copy_from(self, data, table): self.send(('copy', data.read(), table))
+    def fetchone(self): return self.rows.pop(0) if self.rows else None
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+    def commit(self): pass
+    def close(self): pass
+    def done(self): self.send(('done',))
 
 ###########################
 ## Define built-in stats ##
@@ -174,6 +1633,156 @@ def postprocess_code(code):
             pass
     return code
 
+class CodeOptimiser(object):
+    """
+    Optimises the collect_data function that inline_code assembles, on its syntax tree rather than its text, so it works the
+    same for every .stat module and reader. Only the per-read loop is touched, and only in ways that can't change what gets
+    counted:
+      - Merges repeated reads of the same field. Once "SEQ = read.seq" has run, a later read.seq in the loop just uses SEQ.
+      - Inlines single-use accessors. "CIGAR = read[5]" followed by one use of CIGAR becomes that one use of read[5].
+      - Drops assignments to anything nothing reads, like a stat no analysis group (or other stat) consumes.
+      - Hoists the globals the loop reads (.before lookup tables, helper functions, builtins) into locals, by making them
+        default arguments of collect_data, so each read looks them up with LOAD_FAST instead of through the globals dict.
+    Names in keep (the unlinkable stats, which are read once collect_data is done) are never dropped.
+    Accessors are names, attributes and constant subscripts of names - nothing that calls anything - so evaluating one
+    earlier, later, or fewer times changes nothing. optimise() returns the tree, ready for compile(), and notes what it did.
+    """
+    def __init__(self, code, keep=(), namespace=None):
+        self.tree = ast.parse(code)
+        self.keep = set(keep)
+        self.namespace = namespace if namespace is not None else {}
+        self.notes = []
+        self.function = [ node for node in self.tree.body if isinstance(node, ast.FunctionDef) ][0]
+        self.loop = [ node for node in self.function.body if isinstance(node, ast.For) ][0]
+        self.declared = set( name for node in ast.walk(self.function) if isinstance(node, ast.Global) for name in node.names )
+
+    def optimise(self):
+        changed = True
+        while changed:
+            changed = self.mergeReads() | self.inlineAccessors() | self.dropUnused()
+        self.hoistGlobals()
+        ast.fix_missing_locations(self.tree)
+        return self.tree
+
+    ## Helpers
+    def isAccessor(self, node):
+        if isinstance(node, ast.Name): return True
+        if isinstance(node, ast.Attribute): return self.isAccessor(node.value)
+        if isinstance(node, ast.Subscript):
+            return isinstance(node.slice, ast.Index) and isinstance(node.slice.value, (ast.Num, ast.Str)) and self.isAccessor(node.value)
+        return False
+
+    def isPure(self, node):
+        ## No calls, no lambdas/comprehensions - just arithmetic, comparisons, lookups and literals.
+        allowed = (ast.Name, ast.Attribute, ast.Subscript, ast.Index, ast.Slice, ast.Num, ast.Str, ast.Tuple, ast.List, ast.BinOp,
+                   ast.UnaryOp, ast.BoolOp, ast.Compare, ast.IfExp, ast.Load, ast.operator, ast.unaryop, ast.boolop, ast.cmpop)
+        return all(isinstance(child, allowed) for child in ast.walk(node))
+
+    def names(self, node, context):
+        return [ child.id for child in ast.walk(node) if isinstance(child, ast.Name) and isinstance(child.ctx, context) ]
+
+    def stores(self):
+        stored = collections.Counter(self.names(self.function, (ast.Store, ast.Param)))
+        for node in ast.walk(self.function): # x += 1 both reads and writes x
+            if isinstance(node, ast.AugAssign) and isinstance(node.target, ast.Name): stored[node.target.id] += 1
+        return stored
+
+    def singleAssignment(self, index, stored):
+        ## The NAME in a top-level "NAME = accessor" of the loop, if NAME is assigned nowhere else, and what the accessor
+        ## reads can't change after it runs (it is only ever assigned by the loop itself, or once, earlier in the loop).
+        node = self.loop.body[index]
+        if not (isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name)): return None
+        name = node.targets[0].id
+        if name in self.keep or name in self.declared or stored[name] != 1 or not self.isAccessor(node.value): return None
+        loopNames = set(self.names(self.loop.target, ast.Store))
+        for base in self.names(node.value, ast.Load):
+            if base == name: return None
+            if base in loopNames or base in self.declared: continue
+            if stored[base] == 0: continue
+            if stored[base] != 1: return None
+            earlier = [ x for x, statement in enumerate(self.loop.body[:index]) if base in self.names(statement, ast.Store) ]
+            if not earlier: return None
+        return name
+
+    def replace(self, statements, target, replacement, inLoops=True):
+        ## Replaces every read of the expression target (compared by its dump) in statements with a copy of replacement.
+        ## Returns how many were replaced, or -1 (and replaces nothing) if one is somewhere it could run more than once per read.
+        wanted = ast.dump(target)
+        count = [0]
+        class Replacer(ast.NodeTransformer):
+            def visit(self, node):
+                if isinstance(node, ast.expr) and ast.dump(node) == wanted: # Load context is part of the dump
+                    count[0] += 1
+                    return ast.copy_location(copy.deepcopy(replacement), node)
+                return ast.NodeTransformer.visit(self, node)
+        if not inLoops:
+            for statement in statements:
+                for node in ast.walk(statement):
+                    if isinstance(node, (ast.For, ast.While, ast.Lambda, ast.GeneratorExp, ast.ListComp, ast.SetComp, ast.DictComp)):
+                        if any(ast.dump(child) == wanted for child in ast.walk(node)): return -1
+        for x, statement in enumerate(statements): statements[x] = Replacer().visit(statement)
+        return count[0]
+
+    ## Passes
+    def mergeReads(self):
+        changed = False
+        stored = self.stores()
+        for index in range(len(self.loop.body)):
+            name = self.singleAssignment(index, stored)
+            if name is None or isinstance(self.loop.body[index].value, ast.Name): continue
+            value = self.loop.body[index].value
+            if self.replace(self.loop.body[index+1:], value, ast.Name(id=name, ctx=ast.Load())) > 0:
+                self.notes.append('merged repeated reads of ' + self.source(value) + ' into ' + name)
+                changed = True
+        return changed
+
+    def inlineAccessors(self):
+        stored = self.stores()
+        loads = collections.Counter(self.names(self.function, ast.Load))
+        for index in range(len(self.loop.body)):
+            name = self.singleAssignment(index, stored)
+            if name is None or loads[name] != 1: continue
+            if any(name in self.names(statement, ast.Load) for statement in self.loop.body[:index+1]): continue # Used before it's set.
+            value = self.loop.body[index].value
+            rest = self.loop.body[index+1:]
+            if self.replace(rest, ast.Name(id=name, ctx=ast.Load()), value, inLoops=False) != 1: continue
+            self.loop.body[index+1:] = rest
+            del self.loop.body[index]
+            self.notes.append('inlined ' + name + ' = ' + self.source(value))
+            return True
+        return False
+
+    def dropUnused(self):
+        loads = collections.Counter(self.names(self.function, ast.Load))
+        for node in ast.walk(self.function): # x += 1 counts as a read of x
+            if isinstance(node, ast.AugAssign) and isinstance(node.target, ast.Name): loads[node.target.id] += 1
+        for index, node in enumerate(self.loop.body):
+            if not (isinstance(node, ast.Assign) and all(isinstance(target, ast.Name) for target in node.targets)): continue
+            names = [ target.id for target in node.targets ]
+            if any(loads[name] or name in self.keep or name in self.declared for name in names) or not self.isPure(node.value): continue
+            del self.loop.body[index]
+            self.notes.append('dropped unused ' + ', '.join(names))
+            return True
+        return False
+
+    def hoistGlobals(self):
+        local = set(self.stores()) | self.declared | set(['None','True','False'])
+        hoist = []
+        for name in self.names(self.loop, ast.Load):
+            if name in local or name in hoist: continue
+            if name in self.namespace or hasattr(__builtin__, name): hoist.append(name)
+        for name in hoist:
+            self.function.args.args.append(ast.Name(id=name, ctx=ast.Param()))
+            self.function.args.defaults.append(ast.Name(id=name, ctx=ast.Load()))
+        if hoist: self.notes.append('hoisted ' + ', '.join(hoist) + ' into locals')
+
+    def source(self, node):
+        ## Just enough of the source back from an accessor for the notes.
+        if isinstance(node, ast.Name): return node.id
+        if isinstance(node, ast.Attribute): return self.source(node.value) + '.' + node.attr
+        if isinstance(node, ast.Subscript): return self.source(node.value) + '[' + repr(node.slice.value.n if isinstance(node.slice.value, ast.Num) else node.slice.value.s) + ']'
+        return ast.dump(node)
+
 ##########################
 ## Fetch external stats ##
 ##########################################################################################################
@@ -246,10 +1855,19 @@ for statName,statData in sorted(availableStats.items()):
         for dependency in stat.dependencies:
             if dependency not in availableStats: print '\nERROR: The dependency ' + str(dependency) + ' in module ' + statName + ' is not know to SeQC.'
 
+    # DOMAIN
+    if getattr(stat,'DOMAIN',None) is not None:
+        if type(stat.DOMAIN) not in (tuple,list) or len(stat.DOMAIN) != 2 or not all(type(x) in (int,long) for x in stat.DOMAIN) or stat.DOMAIN[0] > stat.DOMAIN[1]:
+            print '\nERROR: The value for self.DOMAIN in module ' + statName + ' must be None or the (lowest, highest) int the stat makes!'; exit()
+        if not stat.LINKABLE: print '\nERROR: The module ' + statName + ' has a DOMAIN but is not LINKABLE. Only linkable stats are counted, so please delete it.'; exit()
+
     # before
     if hasattr(stat,'before') and getattr(stat,'before',None) is not None and stat.before is not False:
         if type(stat.before) is not str: print '\nERROR: The value for self.before in module ' + statName + ' must be None or a string!'; exit()
 
+    # cacheBefore
+    if type(getattr(stat,'cacheBefore',False)) is not bool: print '\nERROR: The value for self.cacheBefore in module ' + statName + ' must be True or False!'; exit()
+
     # after
     if hasattr(stat,'after') and getattr(stat,'after') is not None and stat.after is not False:
         if type(stat.after) is not str: print '\nERROR: The value for self.after in module ' + statName + ' must be None or a string!'; exit()
@@ -309,7 +1927,7 @@ parser.add_argument("--input", nargs='+', metavar='',
     help='Required. One or more SAM (and/or BAM) files to analyse.')
 parser.add_argument("--output", default='myProject.SeQC', metavar='',
     help='Optional. Name of output database (or path for SQLite). Default is "myProject".')
-parser.add_argument("--samtools", default='samtools', metavar='',
+parser.add_argument("--samtools", metavar='',
     help="Optional, unless the path to samtools is needed and cannot be found.")
 parser.add_argument("--quiet", action='store_true',
     help='Optional. No status bars in output. Good for logs, bad for humans.')
@@ -323,12 +1941,43 @@ parser.add_argument("--pghost", default="localhost", metavar='',
     help="Optional. Hostname of postgres database. Default is localhost.")
 parser.add_argument("--cpu", default=2, metavar='', type=int,
     help="Optional. Number of processes/cores you want to use. Default is 2.")
+parser.add_argument("--pool", action='store_true',
+    help="Optional. Analyse files in a pool of --cpu worker processes that are started once, with the stats already loaded, rather than starting a new python for every file. Makes a difference when there are many small files.")
+parser.add_argument("--batch", metavar='', type=int,
+    help="Optional. Analyse small files this many at a time in each process, with one database connection, writing all their tables and INFO rows in a single transaction at the end of the batch. For projects with thousands of small files. Default is off.")
+parser.add_argument("--split", metavar='', type=int,
+    help="Optional. Split each BAM file over this many processes. Default is --cpu divided by the number of input files.")
+parser.add_argument("--threads", default=0, metavar='', type=int,
+    help="Optional. Threads per process used to decompress BAM files ahead of the stats. Default is 0 (no extra threads). Each file's Completed message then says how often the stats waited for decompressed blocks (more threads would help) and how often the queue was full (they would not).")
+parser.add_argument("--sample", metavar='', type=float,
+    help="Optional. Only analyse this fraction of the reads (e.g. 0.01 for 1%%), and scale the counts back up afterwards. Good for quick QC.")
+parser.add_argument("--sampleblocks", action='store_true',
+    help="Optional. With --sample or --maxreads, take random chunks of BGZF blocks from across the BAM instead of random reads, so most of the file is never read.")
+parser.add_argument("--maxreads", metavar='', type=int,
+    help="Optional. Only analyse about this many reads of each file, picked at random from across the whole file, and scale the counts up to the file's total reads.")
+parser.add_argument("--region", action='append', metavar='',
+    help="Optional. Only analyse reads overlapping this region, given like samtools: chr1, chr1:10000 or chr1:10,000-20,000. Can be used more than once. Fastest when the BAM has an index (.bai/.csi) next to it. BAM files only.")
+parser.add_argument("--regionsbed", metavar='',
+    help="Optional. Like --region, but the regions are read from a BED file.")
+parser.add_argument("--vector", action='store_true',
+    help="Optional. Count groups whose stats all have a VECTOR method with NumPy, a whole batch of reads at a time. Built-in BAM reader only, and not with --region, or --sample/--maxreads without --sampleblocks.")
+parser.add_argument("--memorylimit", metavar='', type=int,
+    help="Optional. Roughly how many MB the counts of each process may use. Past that, the biggest groups are sorted and spilled to temporary files (in $TMPDIR) and merged back together as their tables are written. For groups with a value per position or per read, like POS or QNAME, on deep files. Default is no limit.")
+parser.add_argument("--columncache", metavar='',
+    help="Optional. Directory where the value each linked stat makes for every read is kept, so that new groups of those stats can be counted from it in seconds rather than by reading the file again. Needs NumPy. The run that writes a file's columns can't use --split. Stats with more than 65536 different values in a file (like QNAME) are not kept. Default is off.")
+parser.add_argument("--onepass", action='store_true',
+    help="Optional. MD5 each file while it is being analysed, rather than reading it once beforehand just for the MD5. Turns off --split, and is ignored with --region/--regionsbed (which only read part of the file).")
+parser.add_argument("--hashcache", default=os.path.join(os.path.expanduser('~'), '.SeQC_hashes'), metavar='',
+    help="Optional. File where the MD5s of input files are remembered between runs, so unchanged files are never hashed twice. Default is ~/.SeQC_hashes. Set to '' to turn the cache off.")
+parser.add_argument("--codecache", default=os.path.join(os.path.expanduser('~'), '.SeQC_code'), metavar='',
+    help="Optional. File where the compiled stats code and the lookup tables the stats build are kept between runs, (those whose stat sets cacheBefore), so each file's process can start without rebuilding them. Default is ~/.SeQC_code. Set to '' to turn the cache off.")
 parser.add_argument("--md5", action='store_true',
     help="Optional. Returns the MD5 checksums of all loaded modules (as SeQC sees them) and exits.")
 parser.add_argument("--debug", action='store_true',
     help="Required. Probably.")
 parser.add_argument("--SAM", help=argparse.SUPPRESS)   # Used internally to tell subprocesses we are reading SAM. Set to either 'stdin' or 'file'.
-parser.add_argument("--BAM", help=argparse.SUPPRESS)   # Used internally to tell subprocesses we reading directly via pysam or htspython.
+parser.add_argument("--BAM", help=argparse.SUPPRESS)   # Used internally to tell subprocesses we reading directly via pybam, pysam or htspython.
+parser.add_argument("--FASTQ", help=argparse.SUPPRESS) # Used internally to tell subprocesses we are reading FASTQ. Always 'file'.
 args = parser.parse_args()
 
 ## Print MD5s (without anything after the addStat) to make registering other modules as compatible easier.
@@ -340,6 +1989,25 @@ if args.md5:
         print 'Compatible With:'.rjust(16),stat['compatible'],'\n';
     exit()
 
+## With --pool, the workers are forked now, while all they have is the stats. In the fork that analyses a file, we carry on from here as
+## that file's subprocess, with the arguments the parent would have started it with.
+pool = None
+if args.pool and not args.debug and not args.SAM and not args.BAM and not args.FASTQ:
+    pool = WorkerPool(args.cpu)
+    if pool.argv is not None: args = parser.parse_args(pool.argv)
+
+## A subprocess given more than one --input file leads a --batch of them (see FileBatch). In the fork that analyses each file, we carry on from
+## here as that file's subprocess.
+batch = None
+if (args.SAM or args.BAM or args.FASTQ) and len(args.input) > 1:
+    def batchConnection():
+        if args.pguser != None: return psycopg2.connect(dbname=args.output, user=args.pguser, host=args.pghost, password=args.pgpass)
+        con = sqlite3.connect(args.output, timeout=120)
+        con.isolation_level = None
+        return con
+    batch = FileBatch(args.input, batchConnection, args.pguser != None, args.debug)
+    args.input = [batch.inputFile]
+
 ## It takes your stats and returns all stats (so, includes the dependencies, and the dependencies of dependencies..)
 def get_all_modules_to_run(stat_name):
     if hasattr(availableStats[stat_name]['init'],'dependencies'):
@@ -355,7 +2023,7 @@ def get_all_modules_to_run(stat_name):
 if args.analysis is None:
     args.analysis = [('RNAME', 'TYPE', 'FLAG', 'GC'),('TLEN',)] # Default analyses
 
-if not args.SAM and not args.BAM:
+if not args.SAM and not args.BAM and not args.FASTQ:
     print '   [ ' + str(len(availableStats)) + ' Modules Loaded! ]'
 # We make each linked group of stats a set, before converting to a tuple, in the event that the user adds the same stat twice, eg. -a gc gc becomes just (gc).
 # We also sort by stat name in each linked group of stats so "-a tlen gc" becomes (gc,tlen).
@@ -379,8 +2047,84 @@ for analysis in topological_order:
     if analysis in allAnalyses:
         sorted_analyses.append(analysis)
 
-## args.SAM and args.BAM are only ever present in subprocesses. The main parent python code (executed by the user) starts below:
-if not args.SAM and not args.BAM:
+## Sampled analyses are flagged as such in INFO, and a sampled group is not good enough to skip if this run is not sampling:
+if args.sample is not None and not 0 < args.sample <= 1:
+    print '\nERROR: --sample must be the fraction of reads you want to analyse, between 0 and 1 (e.g. 0.01 for 1%)'; exit()
+if args.maxreads is not None and args.maxreads < 1:
+    print '\nERROR: --maxreads must be at least 1'; exit()
+sampling = args.sample is not None or args.maxreads is not None
+## Likewise, results for --region/--regionsbed only count as done for the exact same set of regions:
+try: regions = parseRegions(args.region, args.regionsbed)
+except (AttributeError, ValueError, IndexError, IOError):
+    print '\nERROR: Could not understand your --region/--regionsbed. Regions look like chr1, chr1:10000 or chr1:10000-20000, and BED files need chrom, start and end columns.'; exit()
+regionNames = [ regionString(region) for region in regions ] if args.region or args.regionsbed else None
+## and they never replace the results for the whole file (or for other regions) - their tables and analyses keys end in _REGIONS and a short
+## digest of the regions, e.g. 2dfdd09ddb42ef2fab575012815a06b6_TLEN_RNAME_REGIONS1f3e5a7b.
+regionTag = '_REGIONS' + hashlib.md5(json.dumps(regionNames)).hexdigest()[:8] if regionNames is not None else ''
+def groupKey(group):
+    return '_'.join(group) + regionTag
+def alreadyDone(group, analyses):
+    if groupKey(group) not in analyses: return False
+    metadata = analyses[groupKey(group)]
+    return (sampling or not metadata.get('sampled')) and metadata.get('regions') == regionNames
+
+## The group planner. A linked group whose stats are all in another group being counted isn't counted read by read - once the
+## file is done, its counts are summed up from the bigger group's (a rollup). Only the groups that aren't in any other group are
+## really counted. Returns { group_idx: (superset group_idx, positions of the group's stats in the superset's keys) }.
+def planRollups(groups, counted):
+    rollups = {}
+    finest = [ idx for idx in counted if not any([ set(groups[idx]) < set(groups[other]) for other in counted ]) ]
+    for idx in counted:
+        supersets = [ other for other in finest if set(groups[idx]) < set(groups[other]) ]
+        if not supersets: continue
+        superset = min(supersets, key=lambda other: len(groups[other]))
+        rollups[idx] = (superset, [ groups[superset].index(stat) for stat in groups[idx] ])
+    return rollups
+
+def splitGroupName(name):
+    ## '_'.join(group) back into the group. Stat names can have a _ in them too (like TAG_NAMES), so we go by the stats we know.
+    if name in availableStats: return (name,)
+    for stat in availableStats:
+        if name.startswith(stat + '_'):
+            rest = splitGroupName(name[len(stat)+1:])
+            if rest: return (stat,) + rest
+    return None
+
+def finerTable(group, analyses):
+    ## A group can also be summed up from the table of a finer group already in the database, without reading the file at all.
+    ## That table has to be from an unsampled read of the whole file, by the same version of every stat in the group.
+    ## Returns the finer group with the fewest rows, or None.
+    best = None
+    for name, metadata in analyses.iteritems():
+        other = splitGroupName(name)
+        if other is None or not set(group) < set(other) or metadata.get('rows') is None: continue
+        if metadata.get('sampled') or metadata.get('regions') is not None: continue
+        if not all([ availableStats[stat]['init'].LINKABLE for stat in other ]): continue
+        hashes = dict(zip(other, metadata.get('stat_hashes', [])))
+        if any([ hashes.get(stat) != availableStats[stat]['hash'] for stat in group ]): continue
+        if best is None or metadata['rows'] < analyses['_'.join(best)]['rows']: best = other
+    return best
+
+def estimateCost(inputFile, groups, hashed, sampleBytes=1024*1024):
+    ## Roughly how much work analysing a file will be, so the parent can start the biggest files first: the number of reads that will
+    ## be analysed, times the number of stats each read goes through (plus one for reading it, and one more if the file has to be MD5'd).
+    reads = indexReadCount(inputFile) if bamCheck(inputFile) and not fastqCheck(inputFile) else None
+    if reads is None: reads = estimateReadCount(inputFile, sampleBytes) or 0
+    if args.maxreads is not None: reads = min(reads, args.maxreads)
+    if args.sample is not None and args.sampleblocks: reads *= args.sample
+    stats = set()
+    for group in groups:
+        for stat in group: stats.update(get_all_modules_to_run(stat))
+    return reads * (len(stats) + 1 + (0 if hashed else 1))
+
+def lptMakespan(costs, workers):
+    ## How long a largest-first schedule of these costs over this many workers takes (the biggest total any one worker gets).
+    loads = [0] * max(1, workers)
+    for cost in sorted(costs, reverse=True): heapq.heapreplace(loads, loads[0] + cost)
+    return max(loads)
+
+## args.SAM, args.BAM and args.FASTQ are only ever present in subprocesses. The main parent python code (executed by the user) starts below:
+if not args.SAM and not args.BAM and not args.FASTQ:
     subprocesses = {}
 
     ## First we check for any updates to SeQC.js.py -- nothing is ever auto-installed, this is just a warning.
@@ -428,6 +2172,17 @@ Please use the exact name of the output file you want (you can always rename it
 You have specified a postgres username (and therefore want to use postgres) but you have not installed psycopg2!
 Please install it via "pip install --user psycopg2"'''; exit()
 
+    if args.vector and not numpyInstalled: print '''
+You have asked for --vector, but you have not installed numpy!
+Please install it via "pip install --user numpy"'''; exit()
+
+    if args.columncache and not numpyInstalled: print '''
+You have asked for a --columncache, but you have not installed numpy!
+Please install it via "pip install --user numpy"'''; exit()
+
+    if args.memorylimit is not None and args.memorylimit < 1:
+        print '\nERROR: --memorylimit is in MB, and has to be at least 1.'; exit()
+
     ## Check that the files the user wants to analyse can be accessed:
     ## If a file becomes inaccesible later it will be skipped, but a check early on dosen't hurt...
     usedInputs = []
@@ -441,27 +2196,30 @@ Please install it via "pip install --user psycopg2"'''; exit()
     explicitStats = ''
     for group in args.analysis: explicitStats += ' --analysis ' + ' '.join(group)
     if args.writeover: explicitStats += ' --writeover'
+    if args.onepass: explicitStats += ' --onepass'
+    if args.vector: explicitStats += ' --vector'
+    if args.memorylimit is not None: explicitStats += ' --memorylimit ' + str(args.memorylimit)
+    if args.columncache: explicitStats += ' --columncache "' + os.path.abspath(args.columncache) + '"'
+    if args.sample is not None: explicitStats += ' --sample ' + repr(args.sample)
+    if args.sampleblocks: explicitStats += ' --sampleblocks'
+    if args.maxreads is not None: explicitStats += ' --maxreads ' + str(args.maxreads)
+    for region in args.region or []: explicitStats += ' --region "' + region + '"'
+    if args.regionsbed: explicitStats += ' --regionsbed "' + os.path.abspath(args.regionsbed) + '"'
+    explicitStats += ' --hashcache "' + args.hashcache + '"'
+    explicitStats += ' --codecache "' + args.codecache + '"'
     if args.pguser != None:
         explicitStats += ' --pguser "' + args.pguser + '" --pgpass "' + password + '" --pghost "' + args.pghost + '"'
 
-    ## This function checks to see if a file is binary (BAM) or ASCII (SAM) by looking for a "null byte" (0x00) in the first 20Mb of the file.
-    def bamCheck(fileName):
-        with open(fileName, 'rb') as xamfile:
-            for i in range(10): # 10 tries to find a null byte in 2Mb chunks.
-                section = xamfile.read(2048)
-                if '\0' in section:            return True  # BAM file.
-                if len(section) < 2048:
-                    if i == 0 and not section: return None  # Empty file.
-                    else:                      return False # SAM file.
-
-    ## We only need samtools if we have one or more BAM files. Here we check all files with the bamCheck function,
-    ## and if a binary file is found, we check if we can find/execute samtools.
-    gotSAM,gotBAM,samtoolsInstalled = False, False, None # If user gives lots of files, we could have both.
+    ## We only need samtools if we have one or more BAM files, and even then only if none of the other file readers can run the
+    ## stats we want. Here we check all files with the bamCheck function, and if a binary file is found, we check if we can find/execute samtools.
+    gotSAM,gotBAM,gotFASTQ,samtoolsInstalled = False, False, False, None # If user gives lots of files, we could have all three.
     DEVNULL = open(os.devnull, 'wb')
     if args.debug: STDERR = subprocess.STDOUT
     else: STDERR = DEVNULL
     for inFile in usedInputs:
-        if bamCheck(inFile):
+        if fastqCheck(inFile): gotFASTQ = True
+        elif not bamCheck(inFile): gotSAM = True
+        else:
             gotBAM = True
             if not args.samtools:
                 exitcode = subprocess.call('samtools', stdout=DEVNULL, stderr=DEVNULL, shell=True)
@@ -476,13 +2234,15 @@ Please install it via "pip install --user psycopg2"'''; exit()
                 else: samtoolsInstalled = True
 
     ## Check that all the used stats have a method for this kind of data:
-    blocking = {'sam':False,'pysam':False,'htspython':False}
+    blocking = {'sam':False,'pysam':False,'htspython':False,'pybam':False}
     for stat in sorted_analyses:
         if gotSAM:
             # Here we can only use the sam fileReader. Perhaps I should extend this to allow for pysam/hts if they can work on SAM files... hm..
             availableStats[stat]['init'] =  availableStats[stat]['class']({'fileReader':'sam'}) # re-init with the sam fileReader
             if availableStats[stat]['init'].METHOD == None: blocking['sam'] = stat
         if gotBAM:
+            availableStats[stat]['init'] = availableStats[stat]['class']({'fileReader':'pybam'}) # re-init with the built-in BAM reader
+            if availableStats[stat]['init'].METHOD == None: blocking['pybam'] = stat
             if htspythonInstalled:
                 availableStats[stat]['init'] = availableStats[stat]['class']({'fileReader':'htspython'}) # re-init with htspython
                 if availableStats[stat]['init'].METHOD == None: blocking['htspython'] = stat # Since we cannot use it.
@@ -495,12 +2255,28 @@ Please install it via "pip install --user psycopg2"'''; exit()
                 availableStats[stat]['init'] = availableStats[stat]['class']({'fileReader':'sam'}) # re-init with sam
                 if availableStats[stat]['init'].METHOD == None: blocking['sam'] = stat
             else:blocking['sam'] = stat
+    ## FASTQ files are always read with the FASTQ reader, so every stat (and everything it depends on) must have a fastq METHOD. Stats
+    ## about alignments never will, so they have to be run separately on the aligned files:
+    if gotFASTQ:
+        for stat in sorted_analyses:
+            if availableStats[stat]['class']({'fileReader':'fastq'}).METHOD == None:
+                print '\nERROR: Some of your input files are FASTQ, but the stat ' + stat + ' needs alignment data that FASTQ does not have.'
+                print 'Only stats like SEQ, QUAL, QNAME and GC can be calculated on FASTQ. Run your FASTQ and SAM/BAM files separately.\n'; exit()
+        if regionNames is not None: print '\nERROR: --region and --regionsbed only work on BAM files, but some of your input files are FASTQ.'; exit()
+
+    ## Only the built-in BAM reader and samtools know how to use the index to read just the --region/--regionsbed reads:
+    if regionNames is not None:
+        if gotSAM: print '\nERROR: --region and --regionsbed only work on BAM files, but some of your input files are SAM.'; exit()
+        blocking['htspython'] = blocking['htspython'] or '--region'
+        blocking['pysam'] = blocking['pysam'] or '--region'
     if all(blocking.values()):
         print '\nERROR: The combination of stats you have selected can not be gathered, because there is no method for '
-        print 'reading the file (sam/pysam/htspython) that all the stats can use, specifically:'
+        print 'reading the file (sam/pysam/htspython/pybam) that all the stats can use, specifically:'
         for x,y in blocking.items(): print y,'does not work with',x
         print '\nEither hack on the stat modules to get them to work for these other file readers, or if you are not linking these conflicting stats, run SeQC multiple times.\n'
         exit()
+    elif not gotSAM and not gotBAM: INFO = {'fileReader':'fastq'} ## All FASTQ, which is always read with the FASTQ reader.
+    elif not blocking['pybam']:     INFO = {'fileReader':'pybam'}
     elif not blocking['htspython']: INFO = {'fileReader':'htspython'}
     elif not blocking['pysam']:     INFO = {'fileReader':'pysam'}
     elif not blocking['sam']: INFO = {'fileReader':'sam'}
@@ -523,8 +2299,11 @@ Please install it via "pip install --user psycopg2"'''; exit()
                             "json_stats"    TEXT,
                             "last_updated"  TEXT,
                             "creation_time" TEXT,
-                            "total_reads"   INT
+                            "total_reads"   INT,
+                            "fingerprint"   TEXT
                         )'''
+    ## fingerprint is a quick hash of the file's size, mtime, start and end (see quickFingerprint) so --onepass runs can find a file's row before they know its MD5.
+    ## INFO tables made before it existed get the column added.
     ## The data gets added to INFO by subprocesses (after all stats for that input file have been calculated).
 
     ## The table schema for the SERVER table.
@@ -569,6 +2348,8 @@ Please install it via "pip install --user psycopg2"'''; exit()
             if cur.fetchone()[0] != 1:
                 print '   [    Creating INFO table    ]'
                 cur.execute(infoTableCreation)
+            elif 'fingerprint' not in [ column[1] for column in cur.execute('PRAGMA table_info("INFO")') ]:
+                cur.execute('ALTER TABLE "INFO" ADD COLUMN "fingerprint" TEXT')
             cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='SERVER';")
             if cur.fetchone()[0] != 1:
                 print '   [   Creating SERVER table   ]'
@@ -617,6 +2398,8 @@ If you do not know what caused this error, please e-mail john@john.uk.com with t
             if cur.rowcount != 1:
                 print '   [    Creating INFO table    ]'
                 cur.execute(infoTableCreation)
+            else:
+                cur.execute('ALTER TABLE "INFO" ADD COLUMN IF NOT EXISTS "fingerprint" TEXT')
             cur.execute("SELECT * from information_schema.tables where table_name='SERVER'")
             if cur.rowcount != 1:
                 print '   [   Creating SERVER table   ]'
@@ -648,22 +2431,91 @@ If you do not know what caused this error, please e-mail longinotto@immunbio.mpg
             if cur: cur.close()
             if con: con.close()
 
+    ## Before starting any subprocesses, rule out the inputs we already can. Inputs that are really the same file (symlinks, hard links, or copies
+    ## the --hashcache knows have the same MD5) are only analysed once, and if the --hashcache knows a file's MD5 and that file's INFO row
+    ## already has every --analysis group, the file is skipped without a subprocess ever having to read it.
+    hashCache = HashCache(args.hashcache)
+    if args.pguser == None: con = sqlite3.connect(args.output, timeout=120)
+    else:                   con = psycopg2.connect(dbname=args.output, user=args.pguser, host=args.pghost, password=password)
+    cur = con.cursor()
+    seenFiles, seenHashes, remainingInputs, costs = {}, {}, [], {}
+    for inputFile in usedInputs:
+        fileStat = os.stat(inputFile)
+        fileHash = hashCache.lookup(inputFile)
+        original = seenFiles.get((fileStat.st_dev, fileStat.st_ino)) or seenHashes.get(fileHash)
+        if original:
+            print 'File ' + inputFile + ' skipped as it is the same file as ' + original
+            continue
+        seenFiles[(fileStat.st_dev, fileStat.st_ino)] = inputFile
+        groups = args.analysis
+        if fileHash:
+            seenHashes[fileHash] = inputFile
+            if not args.writeover:
+                cur.execute('SELECT "analyses" FROM "INFO" WHERE "hash"=' + ('?' if args.pguser == None else '%s'), (fileHash,))
+                result = cur.fetchone()
+                if result: groups = [ group for group in args.analysis if not alreadyDone(group, json.loads(result[0])) ]
+                if not groups:
+                    print 'File ' + inputFile + ' skipped as it is already in the database.'
+                    continue
+        remainingInputs.append(inputFile)
+        costs[inputFile] = estimateCost(inputFile, groups, fileHash is not None)
+    cur.close(); con.close()
+
+    ## Files are started biggest first (Longest Processing Time first), and the next biggest is started whenever a process finishes,
+    ## so one big file listed last doesn't leave every other CPU idle at the end while it runs on its own.
+    usedInputs = sorted(remainingInputs, key=lambda inputFile: costs[inputFile], reverse=True)
+
+    ## With --batch, files too small for --split to bother with are given to the processes --batch at a time (see FileBatch), so thousands of tiny
+    ## files don't each need their own process, database connections and transactions. A batch only has one kind of file in it, and files that
+    ## are piped in from samtools are always analysed on their own.
+    batches = {} # name -> the files in the batch. The supervisor treats a batch like one file.
+    if args.batch is not None and args.batch > 1:
+        kinds = {}
+        for inputFile in usedInputs:
+            if os.path.getsize(inputFile) >= BamDataReader.MIN_SPLIT: continue
+            if fastqCheck(inputFile): kinds.setdefault('FASTQ', []).append(inputFile)
+            elif not bamCheck(inputFile): kinds.setdefault('SAM', []).append(inputFile)
+            elif INFO['fileReader'] in ('pybam','htspython','pysam'): kinds.setdefault('BAM', []).append(inputFile)
+        for kind, inputFiles in sorted(kinds.items()):
+            for start in range(0, len(inputFiles), args.batch):
+                batchFiles = inputFiles[start:start+args.batch]
+                if len(batchFiles) == 1: continue
+                name = batchFiles[0] + ' (+' + str(len(batchFiles)-1) + ' more)'
+                batches[name] = batchFiles
+                costs[name] = sum([ costs[inputFile] for inputFile in batchFiles ])
+                for inputFile in batchFiles: usedInputs.remove(inputFile)
+                usedInputs.append(name)
+        usedInputs.sort(key=lambda inputFile: costs[inputFile], reverse=True)
+
+    ## When there are fewer files than CPUs, the spare CPUs are used to split the BAM files up into byte ranges:
+    if args.split is None: args.split = max(1, args.cpu // max(1, len(usedInputs)))
+    explicitStats += ' --split ' + str(args.split) + ' --threads ' + str(args.threads)
+
     ## This function fires off the subprocesses which actually analyse the input BAM/SAM data.
     ## It will be called in a loop later as we process the input files.
     def doSeQC(inputFile):
-        if bamCheck(inputFile):
-            if INFO['fileReader'] == 'htspython' or INFO['fileReader'] == 'pysam':
-                subprocessCommand = 'python "' + SeQC + '" --input "' + inputFile + '" --BAM ' + INFO['fileReader'] + ' --output "' + args.output + '" ' + explicitStats
-                if args.debug: print subprocessCommand # Don't run, just print what would have run.
-                else: return subprocess.Popen(subprocessCommand, stdout=subprocess.PIPE, stderr=STDERR, shell=True, executable='/bin/bash')
+        readFrom = None # A command whose output is piped into the subprocess (samtools view), if there is one.
+        inputFiles = batches.get(inputFile, [inputFile])
+        inputs = '--input ' + ' '.join([ '"' + theFile + '"' for theFile in inputFiles ])
+        if fastqCheck(inputFiles[0]):
+            subprocessArgs = inputs + ' --FASTQ file'
+        elif bamCheck(inputFiles[0]):
+            if INFO['fileReader'] in ('pybam','htspython','pysam'):
+                subprocessArgs = inputs + ' --BAM ' + INFO['fileReader']
             else:
-                subprocessCommand = '"' + args.samtools + '" view "' + inputFile + '" | python "' +  SeQC + '" --input "' + inputFile + '" --output "' + args.output + '" --SAM stdin ' + explicitStats
-                if args.debug: print subprocessCommand
-                else: return subprocess.Popen(subprocessCommand, stdout=subprocess.PIPE, stderr=STDERR, shell=True, executable='/bin/bash')
+                regionOptions, regionArgs = '', ''
+                if regionNames is not None:
+                    regionOptions = ' -M' + (' -L "' + args.regionsbed + '"' if args.regionsbed else '') # -M so overlapping regions don't give the same read twice.
+                    regionArgs = ''.join([ ' "' + region + '"' for region in args.region or [] ])
+                readFrom = '"' + args.samtools + '" view -h' + regionOptions + ' "' + inputFile + '"' + regionArgs
+                subprocessArgs = '--input "' + inputFile + '" --SAM stdin'
         else:
-            subprocessCommand = 'python "' + SeQC + '" --input "' + inputFile + '" --SAM file --output "' + args.output + '" ' + explicitStats
-            if args.debug: print subprocessCommand
-            else: return subprocess.Popen(subprocessCommand, stdout=subprocess.PIPE, stderr=STDERR, shell=True, executable='/bin/bash')
+            subprocessArgs = inputs + ' --SAM file'
+        subprocessArgs += ' --output "' + args.output + '" ' + explicitStats
+        if pool is not None: return pool.start(shlex.split(subprocessArgs), readFrom)
+        subprocessCommand = (readFrom + ' | ' if readFrom is not None else '') + 'python "' + SeQC + '" ' + subprocessArgs
+        if args.debug: print subprocessCommand # Don't run, just print what would have run.
+        else: return subprocess.Popen(subprocessCommand, stdout=subprocess.PIPE, stderr=STDERR, shell=True, executable='/bin/bash')
 
     ## Fire off the initial subprocesses to start analysing the data!
     if not args.quiet:
@@ -674,85 +2526,170 @@ Because you are in debug mode, data wont actually be analysed. Below are just th
 You can run them manually, also with or without a "--debug", to see more information on the error you are experiencing.
 -------------------------------------------------------------------------------------------------------------------------------
 '''
-    for index, inputFile in enumerate(usedInputs):
-        if index == args.cpu: break
-        subprocesses[inputFile] = doSeQC(usedInputs.pop(0))
+    startedAt, finishedAt = {}, {} # For the schedule report at the end.
+    for index in range(min(args.cpu, len(usedInputs))):
+        inputFile = usedInputs.pop(0)
+        subprocesses[inputFile] = doSeQC(inputFile)
+        startedAt[inputFile] = time.time()
         if not args.quiet and not args.debug:
             print '\033[A   [ ' + str(index+1) + '/' + str(args.cpu) + ' ]'
     if args.debug: exit()
 
+    ## The supervisor. Every subprocess reports to us in lines on its stdout (see pinger in the subprocess code): a phase character
+    ## when it starts something new, ". <percent> <position> <bytes read>" progress lines about once a second, and finally one of
+    ## % (skipped), ? (bad data) or ! (done). We wait on all of their pipes at once with poll(), so a line is handled as soon as it
+    ## arrives, one slow process never holds up the others, and a new file is started the moment a process finishes.
+    phases = { '#': 'Calculating MD5         |',                                                ## Statuses are always
+               '|': 'Calculating Statistics  |',                                                ## exactly 25 characters
+               '&': 'Converting to SQL table |',                                                ## in width and include
+               '@': 'Writing To Database     |',                                                ## the starting pipe "|"
+               '$': 'Postgres Table Indexing |' }
+    poller = select.poll()
+    watching = {} # stdout file descriptor -> [file, partial line]
+    outputs = {}  # file -> [status, percent, position, bytes read]
+    allDone = []
+
+    def watch(inputFile):
+        fd = subprocesses[inputFile].stdout.fileno()
+        watching[fd] = [inputFile, '']
+        poller.register(fd, select.POLLIN | select.POLLHUP | select.POLLERR)
+    for inputFile in subprocesses: watch(inputFile)
+
     ## Function to tidy up finished/aborted subprocesses:
-    def tidy(msg):
+    def say(msg):
         if args.quiet: print msg
         else: allDone.append(msg)
-        del subprocesses[theFile]
-        try: del outputs[theFile]
-        except KeyError: pass
-
-    ## Subprocesses always respond with 1 character of status data every 1 second (unless they have become unresponsive)
-    ## This is because when I first wrote SeQC 2 years ago, I didnt know about select.select() and non-blocking stdout reading.
-    ## In the future I will use select, but even though the below is ugly as hell, it's never failed me yet!
-    ## Basically we draw the status bars, and submit new subprocesses when old ones complete.
-    print '\n\nCalculating Statistics..'
-    outputs = {}
-    timeToWrite = []
-    arrow = '>'
-    allDone = []
-    while len(subprocesses) > 0:
-        ## Get the terminal width:
-        terminalRows, terminalCols = map(int,os.popen('stty size', 'r').read().split())
-
-        ## Before we print out the 'active' stuff, lets print out the completed/failed stuff so that it scrolls up and out of the way.
-        for item in allDone: print item.ljust(terminalCols)  ## Using ljust here so we wipe over the stuff previously on this line.
+    def tidy(theFile, msg):
+        if msg: say(msg)
+        handler = subprocesses.pop(theFile)
+        finishedAt[theFile] = time.time()
+        poller.unregister(handler.stdout.fileno())
+        del watching[handler.stdout.fileno()]
+        handler.stdout.close()
+        outputs.pop(theFile, None)
+
+    ## A --batch says "> file" as it starts on each of its files, and each file ends with "+" (analysed, and waiting to be written with the rest
+    ## of the batch), "%" or "?". The batch ends with "!" once everything has been written, or "?" if writing it failed. Returns False for the lines
+    ## any process can say.
+    batchState = dict( (name, [None, True, []]) for name in batches ) # name -> [file being analysed, if it has ended, files analysed]
+    def reportBatch(name, line):
+        state = batchState[name]
+        if line[:2] == '> ' or line == '!':
+            if not state[1]: say('\nERROR: Process analysing ' + state[0] + ' unexpectedly stopped?!')
+            if line == '!':
+                for theFile in state[2]: say('Completed: ' + theFile + inflationNote(theFile))
+                tidy(name, None)
+            else: state[0], state[1] = line[2:], False
+        elif line == '+': state[1] = True; state[2].append(state[0])
+        elif line == '%': state[1] = True; say('File ' + state[0] + ' skipped as it is already in the database.')
+        elif line == '?' and state[1]: ## No file is being analysed, so it is the batch's write that failed.
+            for theFile in state[2]: say('DATA ERROR: ' + theFile + ' was not written, as writing its batch to the database failed. Rerun with --debug for more info.')
+            tidy(name, None)
+        elif line == '?': state[1] = True; say('DATA ERROR: ' + state[0] + ' aborted by SeQC. Rerun with --debug for more info.')
+        else: return False
+        return True
+
+    ## With --threads, each BGZF InflatePipeline sends "* <threads> <queue size> <times the reader waited> <seconds> <times the queue was full>",
+    ## which are added up for the file (its --split ranges each have their own) and go in its Completed message.
+    inflation = {}
+    def inflationNote(theFile):
+        if theFile not in inflation: return ''
+        threads, depth, waits, waited, full = inflation.pop(theFile)
+        return ' (--threads ' + str(threads) + ': waited for inflated blocks ' + str(waits) + ' times, ' + '%.2f' % waited + 's in all, and the queue of ' + \
+               str(depth) + ' blocks was full ' + str(full) + ' times)'
+
+    def report(theFile, line):
+        status = line[:1]
+        if status == '*':
+            inputFile = batchState[theFile][0] if theFile in batches else theFile
+            try:
+                threads, depth, waits, waited, full = line.split()[1:6]
+                totals = inflation.setdefault(inputFile, [int(threads), int(depth), 0, 0.0, 0])
+                totals[2] += int(waits); totals[3] += float(waited); totals[4] += int(full)
+            except ValueError: pass
+            return
+        if theFile in batches and reportBatch(theFile, line): return
+        if status == '.' and theFile in outputs:
+            try: outputs[theFile][1:] = [ int(value) for value in line.split()[1:4] ]
+            except ValueError: tidy(theFile, 'SeQC ERROR: ' + theFile + ' failed, likely due to a bug in SeQC. Run with "--debug" for more info.')
+        elif status in phases and len(line) == 1: outputs[theFile] = [phases[status], 0, 0, 0]
+        elif line == '%': tidy(theFile, 'File ' + theFile + ' skipped as it is already in the database.')
+        elif line == '?': tidy(theFile, 'DATA ERROR: ' + theFile + ' aborted by SeQC. Rerun with --debug for more info.')
+        elif line == '!': tidy(theFile, 'Completed: ' + theFile + inflationNote(theFile))
+        elif line: tidy(theFile, 'SeQC ERROR: ' + theFile + ' failed, likely due to a bug in SeQC. Run with "--debug" for more info.')
+
+    def terminalWidth():
+        ## Asked of the terminal itself, rather than running "stty size" every time we draw.
+        try: return struct.unpack('hh', fcntl.ioctl(sys.stdout.fileno(), termios.TIOCGWINSZ, '1234'))[1] or 80
+        except (IOError, struct.error): return 80
+
+    ## Draws the finished/failed messages (so they scroll up and out of the way), then some beautiful status bars ;)
+    def draw(arrow):
+        global allDone
+        terminalCols = terminalWidth()
+        for item in allDone: print item.ljust(terminalCols)                 ## Using ljust here so we wipe over the stuff previously on this line.
         allDone = []
-
-        ## Read the 1 byte of status output from all subprocesses:
-        for theFile, handler in subprocesses.items():
-            try: out = handler.stdout.read(1)
-            except: tidy('\nERROR: Process analysing ' + theFile + ' unexpectedly stopped?!')
-
-            if out in ['0','1','2','3','4','5','6','7','8','9']: outputs[theFile][1] += int(out)
-            elif out == '#': outputs[theFile] = ['Calculating MD5         |',0]                                     ## Statuses are always
-            elif out == '|': outputs[theFile] = ['Calculating Statistics  |',0]                                     ## exactly 25 characters
-            elif out == '&': outputs[theFile] = ['Converting to SQL table |',0]                                     ## in width and include
-            elif out == '@': outputs[theFile] = ['Writing To Database     |',0]                                     ## the starting pipe "|"
-            elif out == '$': outputs[theFile] = ['Postgres Table Indexing |',0]
-            elif out == '%': tidy('File ' + theFile + ' skipped as it is already in the database.')
-            elif out == '?': tidy('DATA ERROR: ' + theFile + ' aborted by SeQC. Rerun with --debug for more info.')
-            elif out == '!': tidy('Completed: ' + theFile)
-            else:
-                print 'x'+out+'x'
-                tidy('SeQC ERROR: ' + theFile + ' failed, likely due to a bug in SeQC. Run with "--debug" for more info.')
-
-        ## Print some beautiful status bars ;)
+        if args.quiet: return
         progressBarSpace = int(terminalCols/2)                              ## Use half the screen for the progress bar and status.
         fileNameSpace = terminalCols - progressBarSpace                     ## Use the rest for the file name (full path).
         progressScaling = (progressBarSpace -27) / 100.                     ## -27 because we dont want the scaling factor to know about the status, arrow, or final pipe.
-        arrow = '' if arrow else '>'                                        ## '' is falsey, while '>' is truthy, so this toggles it.
-        for theFile, storedOut in outputs.items():
+        for theFile, (status, percent, position, bytesRead) in outputs.items():
+            if theFile in batches and not batchState[theFile][1]: theFile = batchState[theFile][0] ## The file a batch is on.
             if len(theFile) > fileNameSpace:
                 left = '<-- ' + (theFile + ': ')[-fileNameSpace+4:]         ## <-- to indicate the file name was truncated
             else:
                 left = theFile.ljust(fileNameSpace)
-            right = (storedOut[0] + ('=' * int(storedOut[1] * progressScaling)) + arrow).ljust(progressBarSpace-1) + '|'
-            if not args.quiet: print left + right
-
-        if not args.quiet:
-            for x in range(0,len(outputs)): sys.stdout.write('\033[A')  ## Put the cursor back up as many rows in the terminal as we have data files
+            detail = ''                                                     ## How many reads (and MB) so far, if there's room for it.
+            if status == phases['|'] and position: detail = ' ' + format(position, ',') + ' reads' + (', ' + str(bytesRead >> 20) + ' MB ' if bytesRead else ' ')
+            if len(detail) > progressBarSpace - 27 - int(percent * progressScaling): detail = ''
+            right = (status + ('=' * int(percent * progressScaling)) + arrow).ljust(progressBarSpace - 1 - len(detail)) + detail + '|'
+            print left + right
+        for x in range(0,len(outputs)): sys.stdout.write('\033[A')          ## Put the cursor back up as many rows in the terminal as we have data files
         sys.stdout.flush()
 
+    print '\n\nCalculating Statistics..'
+    arrow, nextDraw = '>', 0
+    while len(subprocesses) > 0:
+        for fd, event in poller.poll(250):
+            theFile, partial = watching[fd]
+            try: chunk = os.read(fd, 65536)
+            except OSError: chunk = ''
+            lines = (partial + chunk).split('\n')
+            watching[fd][1] = lines.pop() if chunk else ''
+            for line in lines:
+                if theFile in subprocesses: report(theFile, line.strip())
+            if not chunk and theFile in subprocesses:
+                tidy(theFile, '\nERROR: Process analysing ' + theFile + ' unexpectedly stopped?!')
+
         ## Run some more subprocesses if we need to:
-        if len(subprocesses) < args.cpu:
-            try:
-                inputFile = usedInputs.pop(0);
-                subprocesses[inputFile] = doSeQC(inputFile)
-            except IndexError: pass ## No more files to process!
+        while len(subprocesses) < args.cpu and usedInputs:
+            inputFile = usedInputs.pop(0)
+            subprocesses[inputFile] = doSeQC(inputFile)
+            startedAt[inputFile] = time.time()
+            watch(inputFile)
+
+        if allDone or time.time() >= nextDraw:
+            arrow = '' if arrow else '>'                                    ## '' is falsey, while '>' is truthy, so this toggles it.
+            draw(arrow)
+            nextDraw = time.time() + 0.5
 
     ## Finished processing data!
-    for item in allDone: print item.ljust(terminalCols) ## print out any outstanding messages.
+    if pool is not None: pool.close()
+    draw(arrow) ## print out any outstanding messages.
     if not args.quiet:
         for x in range(0,len(outputs)+1): print ''  ## put the cursor at the bottom of the terminal.
 
+    ## How the schedule went. The planned time is the largest-first schedule of the estimated costs, at the speed the files really went.
+    if len(finishedAt) > 1:
+        took = dict( (theFile, finishedAt[theFile] - startedAt[theFile]) for theFile in finishedAt )
+        speed = sum(took.values()) / max(1, sum([ costs[theFile] for theFile in took ]))
+        planned = lptMakespan([ costs[theFile] for theFile in took ], args.cpu) * speed
+        actual = max(finishedAt.values()) - min(startedAt.values())
+        ideal = sum(took.values()) / min(args.cpu, len(took))
+        timeString = lambda seconds: str(datetime.timedelta(seconds=int(round(seconds))))
+        print 'Scheduled ' + str(len(took)) + (' files and batches' if batches else ' files') + ' biggest first on ' + str(args.cpu) + ' processes. Planned to take ' + timeString(planned) + \
+              ', took ' + timeString(actual) + ' (all the work divided between the processes would be ' + timeString(ideal) + ').'
+
     ## Due to the way SQLite is implimented, with only 1 process being able to write to the database at a time, indexing has to be done at the very end.
     ## Otherwize, the subprocesses will all have to wait while 1 process indexes, and this bottleneck slows things down considerably. It is not an issue
     ## for Postgres however, which uses multiple worker threads. Below we do the indexing for SQLite.
@@ -765,7 +2702,7 @@ You can run them manually, also with or without a "--debug", to see more informa
             rows = cur.fetchall()
             for row in rows:
                 tableName = row[0]
-                tableColumns = ','.join(tableName.split('_')[1:])
+                tableColumns = ','.join(re.sub('_REGIONS[0-9a-f]{8}$', '', tableName).split('_')[1:])
                 if len(tableName) > 32:
                     print 'Checking index on ' + tableName + ' ...',
                     sys.stdout.flush()
@@ -788,128 +2725,231 @@ You can run them manually, also with or without a "--debug", to see more informa
     print '\nAll done! Have a lovely day :)\n'
     exit()
 
-elif args.BAM or args.SAM:
+elif args.BAM or args.SAM or args.FASTQ:
     ## We are only ever here if we're running from a subprocess!
     inputFile = args.input[0]
 
     ## I wrote this little class to be a generic reporter class that you can
-    ## just drop in to a loop and get back periodic % completion updates
+    ## just drop in to a loop and get back periodic % completion updates.
+    ## Everything we tell the parent's supervisor is one line on stdout: a new phase is just its character (see the supervisor),
+    ## and progress is ". <percent> <position> <bytes of the input read>", at most once every updateTime seconds.
     class pinger:
         def __init__(self,updateTime):
             self.total = None
-            self.percent = None
             self.nextPing = None
             self.updateTime = updateTime
+            self.bytesRead = lambda: 0 # Replaced once we know what we are reading.
         def change(self,mode,total=1):
             self.total = float(total) # float so divisions return accurate floats
-            self.percent = 0
             self.nextPing = self.updateTime + time.time()
-            sys.stdout.write(mode); sys.stdout.flush()
+            sys.stdout.write(mode + '\n'); sys.stdout.flush()
         def pong(self,position=0):
             if time.time() > self.nextPing:
-                percentDiff = int((position/self.total)*100) - self.percent
-                if percentDiff > 0:
-                    sys.stdout.write('9') if percentDiff > 9 else sys.stdout.write(str(percentDiff))
-                    self.percent += percentDiff
-                else: sys.stdout.write('0')
-                sys.stdout.flush()
-                self.nextPing = 1 + time.time()
+                sys.stdout.write('. %d %d %d\n' % (min(100, int((position/self.total)*100)), position, self.bytesRead())); sys.stdout.flush()
+                self.nextPing = self.updateTime + time.time()
     ping = pinger(1)
 
-    ## Get both MD5 hash and read count at the same time.
-    def MD5andCount(inputFile,samtools):
-        ## We want to know the readcount of the BAM/SAM file to make status bars, but running samtools view -c takes an unacceptibly long time. MD5 however is very fast.
-        ## We can do both simultaniously, essentially requiring the same amount of time as running samtools -c on the file.
-        ## But we can go one better, by only passing the first X byte to samtools -c, and then estimating the size of the full file from that sample.
-        estimate = True
+    ## Get both MD5 hash and read count.
+    def MD5andCount(inputFile):
+        readCount = countReads(inputFile)
         sizeInBytes = os.path.getsize(inputFile)
-        pipe = subprocess.PIPE
-        ## samtools doesn't print the count if the file is truncated, so we're stuck with this garbage:
-        if estimate: readCounting = subprocess.Popen('"'+ samtools +'" view -bh - | "'+ samtools +'" view -c -',stderr=pipe,stdin=pipe,stdout=pipe,shell=True,executable='/bin/bash')
-        else:        readCounting = subprocess.Popen('"'+ samtools +'" view -c -',                              stderr=pipe,stdin=pipe,stdout=pipe,shell=True,executable='/bin/bash')
         md5 = hashlib.md5()
         chunkSize = 128 * md5.block_size
         ping.change('#',sizeInBytes)
         with open(inputFile,'rb') as f:
             for x,chunk in enumerate(iter(lambda: f.read(chunkSize), b'')):
                 md5.update(chunk)
-                if not estimate: readCounting.stdin.write(chunk)
-                elif x < 1000:   readCounting.stdin.write(chunk)
                 ping.pong(x*chunkSize)
-        readCounting.stdin.close()
-        readCounting.wait()
-        if estimate:
-            sample = int(readCounting.stdout.read())
-            bytesUsed = chunkSize * 1000.
-            readCount = int( (sample/bytesUsed) * sizeInBytes * 1.07 )
-        else:
-            readCount = int(readCounting.stdout.read())
         return [ readCount , md5.hexdigest() ]
-    total_reads, file_hash = MD5andCount(inputFile,args.samtools)
+
+    ## With --onepass, the file is MD5'd by the reader as the analysis reads it, rather than read through once beforehand just for the MD5.
+    ## Until the read is over we only have the quick fingerprint to find this file's INFO row with - the real MD5 is checked against it afterwards.
+    ## Only the built-in readers read the file themselves, and byte ranges can't be hashed in order, so --onepass also means no --split.
+    ## --region/--regionsbed seek to just the index's chunks, so they are never --onepass either - the whole file has to be hashed for its MD5.
+    ## If the --hashcache already knows this file's MD5, there's nothing to hash at all.
+    hashCache = HashCache(args.hashcache)
+    file_hash = hashCache.lookup(inputFile)
+    onePass = args.onepass and file_hash is None and (args.BAM == 'pybam' or args.SAM == 'file' or args.FASTQ) and regionNames is None
+    fingerprint = quickFingerprint(inputFile)
+    if file_hash or onePass: total_reads = countReads(inputFile)
+    else:
+        total_reads, file_hash = MD5andCount(inputFile)
+        hashCache.store(inputFile, file_hash)
+
+    def existingAnalyses(cur, column, value):
+        ## Returns the hash, analyses and json_stats of the INFO row whose column (hash or fingerprint) matches value - or None if there isn't one.
+        delim = '?' if args.pguser == None else '%s'
+        cur.execute('SELECT "hash", "analyses", "json_stats" FROM "INFO" WHERE "' + column + '"=' + delim, (value,))
+        result = cur.fetchone()
+        if result == None: return None
+        # "analyses" is a dictionary (or a JSON object...) where the key is the --analysis group after a '_'.join(group) (see groupKey - --region runs add their regionTag), with all sorts of meta data as values.
+        # Because analysis groups are always stored/requested in alphabetical order, the key for any given group of analyses is easy to work out.
+        analyses = json.loads(result[1])
+        if type(analyses) != dict:
+            if args.debug: print "\nERROR: In your output database's INFO table, the analyses column for the file " + inputFile + ' (' + result[0] + ') is not a dictionary/object?!'; exit()
+            else: print '?'
+            exit()
+        return [ result[0], analyses, json.loads(result[2]) ]
 
     ## Now we check if any analyses have been performed on this sample before.
     ## If they have and --writeover is not set, we dont do the analysis again.
-    if args.pguser == None: con = sqlite3.connect(args.output, timeout=120)
-    else:                   con = psycopg2.connect(dbname=args.output, user=args.pguser, host=args.pghost, password=args.pgpass)
+    if batch is not None:     con = batch # The batch leader's connection.
+    elif args.pguser == None: con = sqlite3.connect(args.output, timeout=120)
+    else:                     con = psycopg2.connect(dbname=args.output, user=args.pguser, host=args.pghost, password=args.pgpass)
     cur = con.cursor()
     ## We have two options to find out if the table exists - check the SQL database itself, or check the INFO table. Which is 'more correct'? I think checking the INFO table
     ## is, as if it's not there, it doesn't matter whats already in the database, we're expected to add it in over the top - but below is the code to check the database directly
     ## cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='" + file_hash + "';")                                                            ## SQLite
     ## cur.execute("SELECT 1 FROM pg_catalog.pg_class WHERE relkind = 'r' AND relname = '" + args.output + "' AND pg_catalog.pg_table_is_visible(oid) LIMIT 1") ## Postgres
-    cur.execute("SELECT \"analyses\", \"json_stats\" FROM INFO WHERE \"hash\"='" + file_hash + "';")
-    result = cur.fetchone()
-    # "analyses" is a dictionary (or a JSON object...) where the key is the --analysis group after a '_'.join(group), with all sorts of meta data as values.
-    # Because analysis groups are always stored/requested in alphabetical order, the key for any given group of analyses is easy to work out.
-    if result != None:
-        existing_analyses = json.loads(result[0])
-        existing_json_stats = json.loads(result[1])
-        if type(existing_analyses) != dict:
-            if args.debug: print "\nERROR: In your output database's INFO table, the analyses column for the file " + args.input + ' (' + file_hash + ') is not a dictionary/object?!'; exit()
-            else: print '?'
-            exit()
+    if onePass: existing = existingAnalyses(cur, 'fingerprint', fingerprint)
+    else:       existing = existingAnalyses(cur, 'hash', file_hash)
+    if existing != None:
+        expected_hash, existing_analyses, existing_json_stats = existing
         if not args.writeover:
             skip = set()
             for group in args.analysis:
-                if '_'.join(group) in existing_analyses:
+                if alreadyDone(group, existing_analyses):
                     skip.add(group)
             for x in skip:
                 args.analysis.remove(x)
             if len(args.analysis) == 0:
-                sys.stdout.write('%'); sys.stdout.flush() # Skipping
+                sys.stdout.write('%\n'); sys.stdout.flush() # Skipping
                 exit()
     else:
+        expected_hash = None
         existing_analyses = {}
         existing_json_stats = {}
     if cur: cur.close()
     if con: con.close()
 
+    ## Plan the groups. Groups that a finer table already in the database covers are summed up from it with SQL (derived), and of
+    ## the rest, linked groups that are inside another group are summed up from that group's counts (rollups). Only what is left
+    ## is counted read by read - and if every group is derived, the file isn't read at all.
+    derived = {}
+    if not args.writeover and not sampling and regionNames is None and not onePass:
+        for group_idx, group in enumerate(args.analysis):
+            if all([ availableStats[stat]['init'].LINKABLE for stat in group ]):
+                finer = finerTable(group, existing_analyses)
+                if finer: derived[group_idx] = finer
+    counted = [ group_idx for group_idx, group in enumerate(args.analysis) if group_idx not in derived and all([ availableStats[stat]['init'].LINKABLE for stat in group ]) ]
+    rollups = planRollups(args.analysis, counted)
+    if args.debug:
+        for group_idx, finer in sorted(derived.items()): print 'Planner: ' + '_'.join(args.analysis[group_idx]) + ' from the ' + '_'.join(finer) + ' table'
+        for group_idx, (superset, columns) in sorted(rollups.items()): print 'Planner: ' + '_'.join(args.analysis[group_idx]) + ' rolled up from ' + '_'.join(args.analysis[superset])
+
     ## Finally, we now start analyzing the data...
-    ping.change('|',total_reads)
+    ping.change('|',total_reads or 1)
     data = [collections.defaultdict(int) for x in range(0,len(args.analysis))] # a list of dictionaries, one for every analysis group.
+    spiller = CountSpiller(args.memorylimit * 1024 * 1024 if args.memorylimit else None) # Spills data to disk past --memorylimit.
+    def checkMemory(): spiller.check(data)
+    TABLE_CHUNK = 100000 if args.memorylimit else None # Rows put into the database at a time. Without --memorylimit, the whole table.
+    def initStats(fileReader):
+        ## Re-init every stat for the reader we are using, with any TAG('XX') in its METHOD swapped for that reader's way of getting the tag.
+        for stat in sorted_analyses:
+            availableStats[stat]['init'] = availableStats[stat]['class']({'fileReader':fileReader})
+            availableStats[stat]['init'].METHOD = withTagAccessors(availableStats[stat]['init'].METHOD, fileReader)
+    readTarget = 'read' # What each read gets unpacked into in collect_data. The built-in BAM reader unpacks straight into bam_* variables.
+    perReadStats, vectorGroups = sorted_analyses, [] # Stats run by collect_data, and groups counted by the --vector engine instead.
     if args.SAM:
-        # for stat in availableStats:
-        #     availableStats[stat].process = availableStats[stat].SAM
-        # if args.SAM == 'stdin':
-        #     sys.argv = '' ## Done so fileinput takes stdin and not args.
-        #     inputData = csv.reader(fileinput.input(), delimiter='\t')
-        # else:
-        #     inputData = csv.reader(fileinput.input(inputFile), delimiter='\t') # fileinput also can read a file on disk
-        # header = json.dumps('')
-        pass
-    elif args.BAM:
+        initStats('sam')
+        ## Only split each line as far as the last column any stat looks at. If a stat uses the read in any
+        ## other way than read[N] (like the tags in read[11:]), every column is split out.
+        columns, allColumns = set(), False
         for stat in sorted_analyses:
-            availableStats[stat]['init'] = availableStats[stat]['class']({'fileReader':args.BAM})
-        if args.BAM == 'htspython':
+            method = availableStats[stat]['init'].METHOD or ''
+            columns.update([ int(column) for column in re.findall(r'\bread\[(\d+)\]', method) ])
+            if re.search(r'\bread\b(?!\[\d+\])', method): allColumns = True
+        if args.SAM == 'stdin': inputData = SamtoolsDataReader(sys.stdin, columns, allColumns)
+        elif onePass:           inputData = SamtoolsDataReader(HashingFile(open(inputFile,'rb')), columns, allColumns)
+        else:                   inputData = SamtoolsDataReader(open(inputFile,'rb'), columns, allColumns)
+        header = json.dumps(inputData.header)
+    elif args.BAM:
+        initStats(args.BAM)
+        if args.BAM == 'pybam':
+            ## With --vector, groups where every stat (and everything it depends on) has a VECTOR method are counted with NumPy, a batch
+            ## of reads at a time. Only the stats the other groups need are still run one read at a time by collect_data.
+            ## Reads picked one at a time (--sample/--maxreads without --sampleblocks) and --region reads can't be batched, so no --vector there.
+            if args.vector and regionNames is None and (not sampling or args.sampleblocks):
+                for group_idx, group in enumerate(args.analysis):
+                    if group_idx in derived or group_idx in rollups: continue
+                    if all([ getattr(availableStats[stat]['init'],'VECTOR',None) for member in group for stat in get_all_modules_to_run(member) ]):
+                        vectorGroups.append(group_idx)
+            ## Stats can depend on different things for this reader (GC doesn't need SEQ here), so work out again what collect_data has to run:
+            perReadStats = set()
+            for group_idx, group in enumerate(args.analysis):
+                if group_idx not in vectorGroups and group_idx not in derived:
+                    for member in group: perReadStats.update(get_all_modules_to_run(member))
+            perReadStats = [ stat for stat in sorted_analyses if stat in perReadStats ]
+            ## Only decode the parts of each record that the stats we are running actually use:
+            fields = set()
+            for stat in perReadStats:
+                fields.update(re.findall(r'\bbam_\w+', availableStats[stat]['init'].METHOD or ''))
+            try: inputData = BamDataReader(inputFile, fields, threads=args.threads, hashing=onePass, regions=regions if regionNames is not None else None)
+            except CorruptFile as e:
+                if args.debug: print '\nERROR: ' + str(e)
+                else: print '?'
+                exit()
+            readTarget = inputData.target
+            header = json.dumps(inputData.header)
+        elif args.BAM == 'htspython':
             inputData = hts.Bam(inputFile, "rb")
             header = json.dumps('htspython currently does not support reading the BAM header. If this upsets you please mail the author Brent Pedersen via GitHub:)')
         elif args.BAM == 'pysam':
             inputData = pysam.Samfile(inputFile, "rb")
             header = json.dumps(inputData.header)
-
-    ## Do .before work - run ONCE per module.
-    for analysis in sorted_analyses:
-        if hasattr(availableStats[analysis]['init'],'before'):
-            exec(availableStats[analysis]['init'].before)
+    elif args.FASTQ:
+        initStats('fastq')
+        fields = set()
+        for stat in sorted_analyses:
+            fields.update(re.findall(r'\bfq_\w+', availableStats[stat]['init'].METHOD or ''))
+        inputData = FastqDataReader(HashingFile(open(inputFile,'rb')) if onePass else open(inputFile,'rb'), fields)
+        readTarget = inputData.target
+        header = json.dumps(inputData.header)
+
+    ## How far through the input file we are, for the progress reports (a pipe from samtools can't tell us):
+    def bytesRead():
+        try: return inputData.handle.tell()
+        except (AttributeError, IOError, ValueError): return 0
+    ping.bytesRead = bytesRead
+
+    ## With a --columncache, if every stat in every group still to be done has a column for this file, the groups are counted from
+    ## those and the file isn't read at all. Otherwise the values of the linked stats collect_data makes anyway are recorded, for next time.
+    columnCache, fromColumns, recordStats = None, False, []
+    if args.columncache and not sampling and regionNames is None and not onePass:
+        statHashes = dict( (stat, availableStats[stat]['hash']) for stat in sorted_analyses )
+        columnCache = ColumnCache(args.columncache, file_hash, 'sam' if args.SAM else 'fastq' if args.FASTQ else args.BAM, statHashes)
+        groupStats = sorted(set([ stat for group_idx, group in enumerate(args.analysis) if group_idx not in derived for stat in group ]))
+        if all([ availableStats[stat]['init'].LINKABLE for stat in groupStats ]) and columnCache.usable(groupStats): fromColumns = True
+        else:
+            recordStats = [ stat for stat in groupStats if stat in perReadStats and availableStats[stat]['init'].LINKABLE and not columnCache.usable([stat]) ]
+            recordStats = columnCache.record(recordStats)
+
+    ## Do .before work - run ONCE per module. Then the --vector engine's own .before work (vectorBefore), for every stat the vectorised groups need.
+    beforeCode = [ (analysis, availableStats[analysis]['init'].before) for analysis in sorted_analyses if getattr(availableStats[analysis]['init'],'before',None) ]
+    if vectorGroups:
+        vectorStats = set()
+        for group_idx in vectorGroups:
+            for member in args.analysis[group_idx]: vectorStats.update(get_all_modules_to_run(member))
+        vectorStats = [ stat for stat in sorted_analyses if stat in vectorStats ]
+        beforeCode += [ (analysis, availableStats[analysis]['init'].vectorBefore) for analysis in vectorStats if getattr(availableStats[analysis]['init'],'vectorBefore',None) ]
+        vectorCode = compile('\n'.join([ textwrap.dedent(availableStats[stat]['init'].VECTOR) for stat in vectorStats ]), '<VECTOR>', 'exec')
+    ## Stats that set cacheBefore promise their .before only makes new names from the code itself (like FLAG's intToFlag), so what
+    ## it makes comes out of the --codecache if it has been run before. It is keyed on its own code and all the .before code run ahead
+    ## of it, which it may build on. Everything else (like CHR, which reads the header) is always run.
+    codeCache = CodeCache(args.codecache)
+    namespace, made, ran = dict(globals()), {}, []
+    for analysis, before in beforeCode:
+        ran.append(before)
+        beforeKey = codeCache.key('before', *ran) if getattr(availableStats[analysis]['init'],'cacheBefore',False) else None
+        values = codeCache.lookup(beforeKey) if beforeKey else None
+        if values is None:
+            previous = dict(namespace)
+            exec(before, namespace)
+            values = dict( (name, value) for name, value in namespace.iteritems() if name not in previous or previous[name] is not value )
+            if beforeKey: codeCache.store(beforeKey, values)
+        namespace.update(values)
+        made.update(values)
+    globals().update(made)
 
     # CPython - the program that usually runs your python scripts -
     # sucks at inlining function calls.  Pypy, a sepurate program that
@@ -937,24 +2977,47 @@ elif args.BAM or args.SAM:
     inline_code('    "(Automatically generated)"', indent='    ')
     inline_code('    ping_pong = ping.pong')
 
+    # Unlinkable stats keep a running result (like TMR += 1) in a global, which is read back once collect_data is done
+    unlinkable = [ stat for stat in perReadStats if not availableStats[stat]['init'].LINKABLE ]
+    if unlinkable: inline_code('global ' + ', '.join(unlinkable))
+
+    # Groups where every stat has a small DOMAIN of ints are counted in a flat list, indexed straight by value (see domainCounter)
+    domainCells, domainCode = {}, {}
+    for i, group in enumerate(args.analysis):
+        domains = [ getattr(availableStats[stat]['init'],'DOMAIN',None) for stat in group ]
+        if i in vectorGroups or i in rollups or i in derived or not all(domains): continue
+        cells, counter = domainCounter(i, group, domains)
+        if cells: domainCells[i], domainCode[i] = [0] * cells, counter
+
     # Declare local variables
     for i in range(len(args.analysis)):
         inline_code('group%d = data[%d]' % (i,i))
+        if i in domainCells: inline_code('cells%d = domainCells[%d]' % (i,i))
+    for stat in recordStats:
+        inline_code('codes_%s, record_%s = columnCache.codes[%r], columnCache.columns[%r].append' % (stat,stat,stat,stat))
 
-    inline_code('for reads_processed, read in enumerate(input):')
+    inline_code('for reads_processed, %s in enumerate(input):' % readTarget)
     inline_code('if reads_processed & 63 == 0: ping_pong(reads_processed)', indent='        ')
+    if args.memorylimit: inline_code('if reads_processed & 16383 == 0: checkMemory()', indent='        ')
+    if recordStats: inline_code('if reads_processed & %d == 0: columnCache.flush()' % (ColumnCache.FLUSH - 1), indent='        ')
 
     # Add stat collection/computation to function
-    for a in sorted_analyses:
+    for a in perReadStats:
         inline_code(availableStats[a]['init'].METHOD)
 
+    # Record the --columncache columns, each value as its code
+    for stat in recordStats:
+        inline_code('record_%s(codes_%s.setdefault(%s, len(codes_%s)))' % (stat,stat,stat,stat))
+
     # Update counters for groups
     for i, group in enumerate(args.analysis):
-        if all([availableStats[stat]['init'].LINKABLE for stat in group]):
+        if i in vectorGroups or i in rollups or i in derived: continue
+        if i in domainCode: inline_code(domainCode[i])
+        elif all([availableStats[stat]['init'].LINKABLE for stat in group]):
             stat_tuple = '(%s,)' % ','.join(group)
             inline_code('group%d[%s] += 1' % (i,stat_tuple))
         else:
-            print("Group %d not linkable because it includes %s. Not counting." % i, stat)
+            if args.debug: print("Group %d not linkable because it includes %s. Not counting." % (i, group[0]))
 
     code = inline_code('', indent='')
 
@@ -969,19 +3032,134 @@ elif args.BAM or args.SAM:
             print postprocessed_code
 
     code = postprocessed_code
-    exec(code, globals())
 
-    # FIXME: This block should go away in production. I'm leaving it for
-    # debugging, and to inspect the generated code.
+    ## The compiled collect_data comes out of the --codecache too. What the optimiser does also depends on which of the names in it are globals.
+    codeKey = codeCache.key('collect_data', code, ','.join(unlinkable), ','.join(sorted(set(re.findall(r'[A-Za-z_]\w*', code)) & set(globals()))))
+    compiled = codeCache.lookup(codeKey)
+    if compiled is None:
+        optimiser = CodeOptimiser(code, keep=unlinkable, namespace=globals())
+        compiled = marshal.dumps(compile(optimiser.optimise(), '<collect_data>', 'exec'))
+        codeCache.store(codeKey, compiled)
+        if args.debug:
+            for note in optimiser.notes: print 'Optimiser: ' + note
+    elif args.debug: print 'Optimiser: collect_data loaded from the --codecache'
+    exec(marshal.loads(compiled), globals())
+
+    ## The reads collect_data counted into flat lists go into data once it's done with a file (or byte range).
+    def foldDomains():
+        for group_idx, cells in domainCells.iteritems():
+            foldDomainCounts(cells, data[group_idx], [ availableStats[stat]['init'].DOMAIN for stat in args.analysis[group_idx] ])
+
+    ## To inspect the generated code, --debug also writes it (and how it was compiled) to inline.f
+    if args.debug:
+        with open('inline.f', 'w') as f:
+            f.write(code)
+            import dis
+            sys.stdout = f
+            dis.dis(collect_data)
+            sys.stdout = sys.__stdout__
+
+    ## The --vector engine. Each batch of reads is turned into NumPy columns, the VECTOR code runs over them all at once, and each
+    ## vectorised group is counted in one go by its PackedCounter. Counts only go into data (as value tuples) once the reader is done.
+    ## Any other groups still get their reads from collect_data.
+    def collectBatches(reader):
+        done, counters = 0, dict( (group_idx, PackedCounter(len(args.analysis[group_idx]))) for group_idx in vectorGroups )
+        for batch, offsets in reader.batches():
+            columns = bamColumns(batch, offsets)
+            exec(vectorCode, globals(), columns)
+            for group_idx in vectorGroups:
+                counters[group_idx].add([ columns[stat] for stat in args.analysis[group_idx] ], len(offsets))
+            if perReadStats: collect_data(reader.recordsAt(batch, offsets))
+            done += len(offsets)
+            ping.pong(done)
+            if args.memorylimit: checkMemory()
+        for group_idx in vectorGroups:
+            counts = data[group_idx]
+            for key, count in counters[group_idx].items(): counts[key] += count
+            checkMemory()
+    collect = collectBatches if vectorGroups else collect_data
+
+    ## If we are allowed to, split the BAM up into byte ranges and run collect_data over each range in its own process.
+    ## Every process counts into its own data, and we merge them all back together here before the SQL is written.
+    ## Unlinkable stats keep their results in variables rather than in data, so they can't be split up like this.
+    ## Nor can recording --columncache columns, which have to be in file order.
+    byteRanges = []
+    linkable = all([ availableStats[stat]['init'].LINKABLE for group in args.analysis for stat in group ])
+    if args.BAM == 'pybam' and args.split > 1 and not onePass and linkable and regionNames is None and not recordStats:
+        byteRanges = inputData.byteRanges(args.split)
+
+    ## With --region/--regionsbed and an index, the progress bar is scaled to how much of the file the region chunks cover:
+    if args.BAM == 'pybam' and inputData.chunks is not None:
+        chunkBytes = sum([ (end >> 16) - (start >> 16) for start, end in inputData.chunks ])
+        ping.total = float(max(1, int((total_reads or 1) * chunkBytes / float(max(1, os.path.getsize(inputFile))))))
+
+    ## With --sample/--maxreads, collect_data only gets some of the reads. --sampleblocks with the built-in BAM reader picks random
+    ## byte ranges from across the file, otherwise every read is decoded and a random --sample of them kept. Counts are scaled up by 1/sampleRate later.
+    ## --maxreads is a random sample too, of the fraction of the file's reads that makes about that many - not the first reads of the file,
+    ## which in a sorted BAM would all be from the start of the first chromosome.
+    sampleRate, scaleCount = 1.0, None
+    sampleFraction = args.sample if args.sample is not None else 1.0
+    if args.maxreads is not None and total_reads: sampleFraction = min(sampleFraction, args.maxreads / float(total_reads))
+    sampleByBlocks = args.sampleblocks and sampling and args.BAM == 'pybam' and regionNames is None
+    if sampleByBlocks: byteRanges, sampleRate = inputData.sampleRanges(sampleFraction)
+    elif sampling:     byteRanges = [] # Random reads come from one stream of reads, so no --split.
+    if sampling:
+        ping.total = float((total_reads or 1) * (sampleRate if sampleByBlocks else sampleFraction) or 1)
+    def sampleReads(reads):
+        rate, rand = (1.0 if sampleByBlocks else sampleFraction), random.random
+        for read in reads:
+            if rate < 1 and rand() >= rate: continue
+            yield read
 
-    with open('inline.f', 'w') as f:
-        f.write(code)
-        import dis
-        sys.stdout = f
-        dis.dis(collect_data)
-        sys.stdout = sys.__stdout__
+    try:
+        if len(derived) == len(args.analysis): pass # Every group comes from a table already in the database.
+        elif fromColumns:
+            if args.debug: print 'Counting ' + str(len(counted) - len(rollups)) + ' group(s) from the --columncache'
+            for group_idx in counted:
+                if group_idx not in rollups: columnCache.count(args.analysis[group_idx], data[group_idx], ping.pong)
+        elif len(byteRanges) > 1 and args.split > 1 and linkable:
+            def collectRange(byteRange):
+                global data
+                data = [collections.defaultdict(int) for x in range(0,len(args.analysis))]
+                collect(BamDataReader(inputFile, fields, *byteRange, threads=args.threads))
+                foldDomains()
+                return [ dict(counts) for counts in data ], spiller.take()
+            splitPool = multiprocessing.Pool(min(args.split, len(byteRanges)))
+            for partialData, runs in splitPool.imap_unordered(collectRange, byteRanges):
+                spiller.adopt(runs)
+                for group_idx, counts in enumerate(partialData):
+                    for key, count in counts.iteritems(): data[group_idx][key] += count
+                    checkMemory()
+            splitPool.close()
+            splitPool.join()
+        elif sampleByBlocks and vectorGroups:
+            for byteRange in byteRanges: collectBatches(BamDataReader(inputFile, fields, *byteRange, threads=args.threads))
+        elif sampleByBlocks:
+            collect_data(sampleReads(itertools.chain.from_iterable( BamDataReader(inputFile, fields, *byteRange, threads=args.threads) for byteRange in byteRanges )))
+        elif sampling:
+            collect_data(sampleReads(inputData))
+        else:
+            collect(inputData)
+        foldDomains()
+        if recordStats: columnCache.save()
+    except CorruptFile as e:
+        spiller.close()
+        if args.debug: print '\nERROR: ' + str(e)
+        else: print '?'
+        exit()
 
-    collect_data(inputData)
+    ## Now the rolled-up groups can be summed up from the counts of the groups they are in (which may be partly spilled to disk).
+    for group_idx, (superset, columns) in sorted(rollups.items()):
+        counts = data[group_idx]
+        for row, (key, count) in enumerate(spiller.rows(superset, data[superset], keep=True)):
+            counts[tuple([ key[column] for column in columns ])] += count
+            if args.memorylimit and row & 65535 == 0: spiller.check(data, busy=[superset])
+
+    ## Work out what fraction of the file was really analysed, and scale the linkable counts back up to the whole file.
+    ## Unlinkable stats keep their results in their own variables, so we can't scale those - they are just flagged as sampled.
+    if sampling:
+        if not sampleByBlocks: sampleRate = sampleFraction
+        if sampleRate < 1: scaleCount = lambda count: int(round(count / sampleRate))
 
     """
     execute  = '\n'
@@ -1021,7 +3199,10 @@ elif args.BAM or args.SAM:
     """
 
     ## Set up some generic database-specific things:
-    if args.pguser == None:
+    if batch is not None:
+        con = cur = batch # Everything is written by the batch leader, in one go at the end.
+        delim = '?' if args.pguser == None else '%s'
+    elif args.pguser == None:
         con = sqlite3.connect(args.output, timeout=120)
         con.isolation_level = 'EXCLUSIVE'
         con.execute('BEGIN EXCLUSIVE')
@@ -1031,62 +3212,91 @@ elif args.BAM or args.SAM:
         con = psycopg2.connect(dbname=args.output, user=args.pguser, host=args.pghost, password=args.pgpass)
         cur = con.cursor()
         delim = '%s'
+
+    ## In --onepass mode we only now know the file's real MD5. If the fingerprint pointed us at the wrong INFO row (or no row), look again by hash.
+    if onePass:
+        file_hash = inputData.handle.hexdigest()
+        hashCache.store(inputFile, file_hash)
+        if file_hash != expected_hash:
+            existing = existingAnalyses(cur, 'hash', file_hash)
+            if existing != None: expected_hash, existing_analyses, existing_json_stats = existing
+            else:                existing_analyses, existing_json_stats = {}, {}
     new_json_stats = {} # stores the json_stats data
     new_analyses = {} # stores the analysis metadata
 
     ## From here on out, we process things one analysis group at a time, until its time to update the INFO table.
     for group_idx, group in enumerate(args.analysis):
-        tableName = file_hash + '_' + '_'.join(group)            # e.g. 2dfdd09ddb42ef2fab575012815a06b6_TLEN_RNAME. Not used for JSON.
+        tableName = file_hash + '_' + groupKey(group)           # e.g. 2dfdd09ddb42ef2fab575012815a06b6_TLEN_RNAME. Not used for JSON.
         cur.execute('DROP TABLE IF EXISTS "' + tableName + '"') # if --writeover wasnt set, and there was already data, the analysis group would have been dropped earlier.
         cur.execute('DROP INDEX IF EXISTS "' + tableName + '_INDEX"')
         ping.change('&',len(args.analysis))
 
+        ## Groups the planner found a finer table for are summed up from it by the database:
+        if group_idx in derived:
+            columns = ', '.join(group)
+            cur.execute('CREATE TABLE "' + tableName + '"(' + ', '.join([stat+' '+availableStats[stat]['init'].SQL for stat in group]) + ', counts INTEGER)')
+            cur.execute('INSERT INTO "' + tableName + '" SELECT ' + columns + ', SUM(counts) FROM "' + file_hash + '_' + '_'.join(derived[group_idx]) + '" GROUP BY ' + columns)
+            cur.execute('SELECT COUNT(*) FROM (SELECT 1 FROM "' + file_hash + '_' + '_'.join(derived[group_idx]) + '" GROUP BY ' + columns + ') AS finer') # Not from the new table, which a --batch hasn't written yet.
+            tableRows = cur.fetchone()[0]
+            con.commit()
+            new_analyses[groupKey(group)] = {
+                'rows'       :   tableRows,
+                'stat_hashes':   [ availableStats[stat]['hash'] for stat in group ],
+                'performed'  :   int(time.mktime(time.gmtime()))*1000 # milliseconds since unix epoch in GMT/UMT
+            }
+
         ## Now what we do depends on if we're linkable or not:
-        if all([ availableStats[x]['init'].LINKABLE for x in group ]):
+        elif all([ availableStats[x]['init'].LINKABLE for x in group ]):
             ## data is currently a list of dictionaries, where the keys of those dictionaries are immutable tuples and the values are read counts. This is not a bag of fun.
             ## So for every dictionary we convert it to a mutable list-of-lists (i.e. a table, for the SQL database). We call this table "table".
-            table = []
-            for stat_columns,read_count in data[group_idx].items():
-                table.append(list(stat_columns) + [read_count])
-                # ping.pong(group_idx) # Could turn this on if this convertion consistently takes longer than 1 second ...
-
-            ## Do .after work. As you can see, this happens for every time the analysis is used in an analysis group, not just once like .before
-            ## This is because .after is often used to modify the generated data, like for RNAME, it converts numerical chromosome ids to real names.
-            for column, analysis in enumerate(group):
-                if hasattr(availableStats[analysis]['init'],'after'):
-                    ping.pong(group_idx)
-                    exec(availableStats[analysis]['init'].after)
-
-            ## Dont add anything when there's nothing to add:
-            if len(table) == 0 or (len(table) == 1 and all(value == None for value in table[0])):
-                if debug: print '\nERROR: No data was collected from the (' + ' '.join(group) + ') analysis, so nothing at all was written to the database!'
-                continue # Move on to next analysis group
-
-            ## OK, now time to add that data to a new table.
-            ping.change('@',len(args.analysis))
-
-            ## Set up LINKABLE=True specific SQL stuff:
-            if args.pguser == None:
-                createColumn = ', '.join([stat+' '+availableStats[stat]['init'].SQL for stat in group]) + ', counts INTEGER'
-                columnQ      = ', '.join([delim]*(len(group)+1)) # +1 for the counts column
-            else:
-                pgMegaString = '' # For postgres we do something a bit funny - we use it's COPY function and provide a huge string, as it's really fast.
-                column_idxs = range(len(table[0]))
-                for row_idx in xrange(0,len(table)):
-                    for column_idx in column_idxs:
-                        if table[row_idx][column_idx] == None:
-                            table[row_idx][column_idx] = '\N' ## postgres identifies null as \N  -  note that its not a special symbol, it's literally just a backslash and a capital N. This can be changed with " WITH NULL AS 'tumblr' " if you'd rather 'tumblr' was the signifier for something with no value.
-                    pgMegaString = '\t'.join(table[row_idx]) + '\n'
-
-            ## Create table
-            cur.execute('CREATE TABLE "' + tableName + '"(' + createColumn + ')')
-            if args.pguser == None:
-                cur.executemany('INSERT INTO "' + tableName + '" VALUES ( ' + columnQ + ' )', table)
-            else:
-                cur.copy_from(StringIO.StringIO(pgMegaString), '"' + tableName + '"')
+            ## With --memorylimit this is done a piece of the table at a time, as the counts are merged back together from disk.
+            rows, tableRows = spiller.rows(group_idx, data[group_idx]), 0
+            while True:
+                table = []
+                for stat_columns,read_count in itertools.islice(rows, TABLE_CHUNK):
+                    table.append(list(stat_columns) + [scaleCount(read_count) if scaleCount else read_count])
+                    # ping.pong(group_idx) # Could turn this on if this convertion consistently takes longer than 1 second ...
+                if len(table) == 0 and tableRows: break
+
+                ## Do .after work. As you can see, this happens for every time the analysis is used in an analysis group, not just once like .before
+                ## This is because .after is often used to modify the generated data, like for RNAME, it converts numerical chromosome ids to real names.
+                for column, analysis in enumerate(group):
+                    if getattr(availableStats[analysis]['init'],'after',None):
+                        ping.pong(group_idx)
+                        exec(availableStats[analysis]['init'].after)
+
+                ## Dont add anything when there's nothing to add:
+                if tableRows == 0 and (len(table) == 0 or (len(table) == 1 and all(value == None for value in table[0]))):
+                    if debug: print '\nERROR: No data was collected from the (' + ' '.join(group) + ') analysis, so nothing at all was written to the database!'
+                    break
+
+                ## OK, now time to add that data to a new table.
+                ping.change('@',len(args.analysis))
+
+                ## Set up LINKABLE=True specific SQL stuff:
+                if args.pguser == None:
+                    createColumn = ', '.join([stat+' '+availableStats[stat]['init'].SQL for stat in group]) + ', counts INTEGER'
+                    columnQ      = ', '.join([delim]*(len(group)+1)) # +1 for the counts column
+                else:
+                    pgMegaString = '' # For postgres we do something a bit funny - we use it's COPY function and provide a huge string, as it's really fast.
+                    column_idxs = range(len(table[0]))
+                    for row_idx in xrange(0,len(table)):
+                        for column_idx in column_idxs:
+                            if table[row_idx][column_idx] == None:
+                                table[row_idx][column_idx] = '\N' ## postgres identifies null as \N  -  note that its not a special symbol, it's literally just a backslash and a capital N. This can be changed with " WITH NULL AS 'tumblr' " if you'd rather 'tumblr' was the signifier for something with no value.
+                        pgMegaString = '\t'.join(table[row_idx]) + '\n'
+
+                ## Create table (on the first piece), and add the rows
+                if tableRows == 0: cur.execute('CREATE TABLE "' + tableName + '"(' + createColumn + ')')
+                if args.pguser == None:
+                    cur.executemany('INSERT INTO "' + tableName + '" VALUES ( ' + columnQ + ' )', table)
+                else:
+                    cur.copy_from(StringIO.StringIO(pgMegaString), '"' + tableName + '"')
+                tableRows += len(table)
+            if tableRows == 0: continue # Move on to next analysis group
             con.commit()
-            new_analyses['_'.join(group)] = {
-                'rows'       :   len(table),
+            new_analyses[groupKey(group)] = {
+                'rows'       :   tableRows,
                 'stat_hashes':   [ availableStats[stat]['hash'] for stat in group ],
                 'performed'  :   int(time.mktime(time.gmtime()))*1000 # milliseconds since unix epoch in GMT/UMT
             }
@@ -1098,8 +3308,8 @@ elif args.BAM or args.SAM:
                 except TypeError:
                     print '\nERROR: The module "' + analysis + ' has returned ' + str(type(unlinkable_result)) + ' data that can not be JSON encoded.'
                     print '       This is a bug in the module. Please advise whomever wrote this stat that it occured and how (if you can)'; exit()
-                new_json_stats[analysis] = unlinkable_result
-                new_analyses['_'.join(group)] = {
+                new_json_stats[analysis + regionTag] = unlinkable_result
+                new_analyses[groupKey(group)] = {
                     'rows'       :   None,
                     'stat_hashes':   [ availableStats[stat]['hash'] for stat in group ],
                     'performed'  :   int(time.mktime(time.gmtime()))*1000 # milliseconds since unix epoch in GMT/UMT
@@ -1118,11 +3328,27 @@ elif args.BAM or args.SAM:
                 # Here we won't use Postgres' COPY function, since this gives the user a bit more flexibility in adding special postgres-specific datatypes (lists/etc).
                 cur.executemany('INSERT INTO "' + tableName + '"(' + ', '.join([x[0] for x in availableStats[analysis]['init'].SQL]) + ') values ( ' + ', '.join([delim for x in availableStats[analysis]['init'].SQL]) + ' )', unlinkable_result)
                 con.commit()
-                new_analyses['_'.join(group)] = {
+                new_analyses[groupKey(group)] = {
                     'rows'       :   len(unlinkable_result),
                     'stat_hashes':   [ availableStats[stat]['hash'] for stat in group ],
                     'performed'  :   int(time.mktime(time.gmtime()))*1000 # milliseconds since unix epoch in GMT/UMT
                 }
+    spiller.close()
+
+    ## Record how each group was sampled (if it was) in its analyses metadata:
+    if sampling and sampleRate < 1:
+        for group in args.analysis:
+            if groupKey(group) in new_analyses:
+                new_analyses[groupKey(group)]['sampled'] = {
+                    'rate'  : sampleRate,
+                    'by'    : 'blocks' if sampleByBlocks else 'reads',
+                    'scaled': all([ availableStats[stat]['init'].LINKABLE for stat in group ])
+                }
+
+    ## And which regions it covered, if it wasn't the whole file:
+    if regionNames is not None:
+        for group in args.analysis:
+            if groupKey(group) in new_analyses: new_analyses[groupKey(group)]['regions'] = regionNames
 
     ## DONE MAKING TABLES! Now we just have to update the INFO table!
     ## First we grab some meta data about the file
@@ -1138,20 +3364,21 @@ elif args.BAM or args.SAM:
         for key,value in new_json_stats.items(): existing_json_stats[key] = value
         existing_analyses   = json.dumps(existing_analyses)
         existing_json_stats = json.dumps(existing_json_stats)
-        cur.execute('INSERT INTO "INFO" ("hash",    "path",    "size",      "header", "analyses",        "file_name", "json_stats",        "last_updated", "creation_time", "total_reads") VALUES (' +  ', '.join((delim,)*10) + ')',
-                                        ( file_hash, file_path, sample_size, header,   existing_analyses, file_name,   existing_json_stats, analysis_time,  creation_time,   total_reads )                                        )
+        cur.execute('INSERT INTO "INFO" ("hash",    "path",    "size",      "header", "analyses",        "file_name", "json_stats",        "last_updated", "creation_time", "total_reads", "fingerprint") VALUES (' +  ', '.join((delim,)*11) + ')',
+                                        ( file_hash, file_path, sample_size, header,   existing_analyses, file_name,   existing_json_stats, analysis_time,  creation_time,   total_reads,   fingerprint )                                        )
     ## An INFO row already exists for this sample...
     else:
         for key,value in new_analyses.items():   existing_analyses[key] = value
         for key,value in new_json_stats.items(): existing_json_stats[key] = value
         existing_analyses   = json.dumps(existing_analyses)
         existing_json_stats = json.dumps(existing_json_stats)
-        sql = 'UPDATE "INFO" SET "path"=$, "analyses"=$, "file_name"=$, "json_stats"=$, "last_updated"=$ WHERE "hash"=$'.replace('$',delim)
-        cur.execute(sql, (file_path, existing_analyses, file_name, existing_json_stats, analysis_time, file_hash))
+        sql = 'UPDATE "INFO" SET "path"=$, "analyses"=$, "file_name"=$, "json_stats"=$, "last_updated"=$, "fingerprint"=$ WHERE "hash"=$'.replace('$',delim)
+        cur.execute(sql, (file_path, existing_analyses, file_name, existing_json_stats, analysis_time, fingerprint, file_hash))
     con.commit()
     cur.close()
     con.close()
-    sys.stdout.write('!'); sys.stdout.flush()
+    if batch is not None: batch.done()
+    sys.stdout.write('+\n' if batch is not None else '!\n'); sys.stdout.flush() # In a --batch, the leader says when it's really done.
 
 
 '''*/
@@ -88,24 +88,47 @@ class stat:                   # dont change this
                                                 # module up into a chain of modules all dependant on the previous modules in the chain. The TYPE module is a good example of this.
                                                 # Dependencies is an optional parameter and can be excluded or set to None/False. If you do wish to provide one or more
                                                 # Dependencies however, you must provide here a list of strings, where the string is the name of the module to run first.
+                                                # What a dependency gives you is the value its METHOD makes for each read - not what ends up in its table. FLAG for example
+                                                # is the flag's integer while the reads are counted, and only its stored table is spelled out in AC.GT letters (by its .after).
+                                                # So a stat that depends on FLAG has to test the bits, like 'FLAG & 4' for an unmapped read (the C letter) or 'FLAG & 16' for
+                                                # the reverse strand (E). Testing for letters, like 'C' in FLAG, doesn't work - it raises a TypeError.
 
         self.METHOD       = 'print "whoop!"'    # The code (as a string) that SeQC should execute for each read it processes in the SAM/BAM file is found in self.METHOD
                                                 # The code can be many lines and do many things - the only criteria is that the final "result" for the stat (per read for 
                                                 # linked stats, or at the very end for unlinked stats) must be stored under the name of the stat itself.
                                                 # You can use indentations in any format you like. Such freedoms. What a time to be alive.
+                                                # Once all the METHODs are put together, SeQC optimises the result (see CodeOptimiser), so a simple accessor like
+                                                # 'CIGAR = read[5]' that is only used once is inlined for you, and your .before tables are looked up as fast locals.
 
         if INFO['fileReader'] == 'sam':         # However, for some modules we need to know exactly how we are reading the file. This is particularly true for the built-in
           self.METHOD = 'QNAME = read[0]'       # functions where we cannot simply use other modules as dependencies (which is usually recommended).
         elif INFO['fileReader'] == 'pysam':     # We do this by passing the "fileReader" variable to the class when we initialize it, and then using that here to decide what
-          self.METHOD = 'QNAME = read.qname'    # the method should be. Currently, values for fileReader can be 'sam', 'pysam' and 'htspython'. There may be more in the future.
+          self.METHOD = 'QNAME = read.qname'    # the method should be. Currently, values for fileReader can be 'sam', 'pysam', 'htspython' and 'pybam' (the built-in BAM reader, which unpacks each read into bam_flag, bam_pos, bam_seq etc. instead of 'read', and only decodes the bam_* fields your METHOD mentions) and 'fastq' (FASTQ input, unpacked into fq_name, fq_seq and fq_qual - stats without a fastq METHOD can't be run on FASTQ files). There may be more in the future.
         elif INFO['fileReader'] == 'htspython': # In fact the INFO my be used in the future to extend modules by setting extra paramters at runtime beyond fileReader.
           self.METHOD = 'QNAME = read.qname'    # If you decide to use multiple methods in your own stat, please make sure your stat always produces *exactly* same output!
         else: self.METHOD = None                # And if you use 'if' like we have here, make sure you end with an 'else: None'!
+                                                # One thing that works the same for every reader is TAG('XX'), the value of the read's XX optional tag (or None).
+                                                # Only that one tag is looked up, so 'RGID = TAG("RG")' is much faster than going through every tag via TAGS.
+
+        self.DOMAIN = None                      # Optional. If your stat only ever makes ints from a small range, say so here as (lowest, highest), like MAPQ's (0, 255).
+                                                # Groups made only of such stats are counted in a flat list indexed by the values, which is faster than a dictionary.
+                                                # Values outside the range (and None) still work, they are just counted the usual way. Never make floats in the range!
 
         self.before = None                      # Some modules require extra processing before reading the file. See the FLAG module as an example. This works exactly
                                                 # like self.METHOD in that it should be a string. This will be run once and only once, no matter how many times your module is
                                                 # called from the command line in multiple groups (because all groups are calculated simultaniously, with no redundancy)
 
+        self.cacheBefore = False                # Optional. Set to True if your .before (and vectorBefore) only makes new variables from the code itself, like FLAG's intToFlag
+                                                # table. What it makes is then kept in the --codecache, so each file's process skips building it. Leave it False if your .before
+                                                # reads the file (like CHR's use of the header) or changes a variable it did not make, as those changes would not be kept.
+
+        self.VECTOR = None                      # Optional, and only used with --vector (built-in BAM reader only). Like self.METHOD, but it runs once per batch of reads
+                                                # rather than once per read, on NumPy arrays with one value per read: bam_tid, bam_pos, bam_mapq, bam_flag, bam_l_seq,
+                                                # bam_rnext, bam_pnext and bam_tlen, plus the VECTOR results of your dependencies under their stat names. So 'TLEN = bam_tlen'
+                                                # makes a whole column of TLENs at once. Your result must come out exactly the same as METHOD's would, read for read.
+                                                # A group is only counted this way if every stat in it (and every dependency) has a VECTOR - otherwise it uses METHOD as usual.
+                                                # Lookup tables your VECTOR needs can be built once in self.vectorBefore, which works just like self.before. See TYPE.
+
         self.after  = None                      # Some modules require extra processing to be done after the file has been read. See the RNAME module as an example.
                                                 # Unlike .before, the code here will run once per occurence of the stat on the command line. This is because .after is often 
                                                 # used to edit/transform the data after it has all been collected. So where is the data?
@@ -113,11 +136,13 @@ class stat:                   # dont change this
                                                 # the SQL database. It will contain as many columns as there were in the analysis group. To get to the data your stat made, 
                                                 # use the "column" variable, which has been set to the id of your data's column in the row. eg. table[column][0]  would be the 
                                                 # first value for the first row in the table that your module created.
+                                                # With --memorylimit, big tables are put into the database a piece at a time, and .after runs once per piece - so
+                                                # .after should only ever change the rows it is given one at a time, like RNAME does.
 
                                                 # IMPORTANT!! Modules that use self.after confuse people when they try to import them as a dependancy and they don't get back
                                                 # something that looks like the final result they are used to - if you use .after, warn users about this in your module 
                                                 # comments! Consider writing a version of your module that can be used as a dependancy if it needs to be, such as CHR is for 
-                                                # RNAME.
+                                                # RNAME. FLAG is one of these too - as a dependency it is the flag's integer, not the AC.GT letters in its table.
 
 addStat('STAT_NAME',[])                         # Finally, to initialize your stat with a name, and a list of MD5 sums of modules it is compatible with.
                                                 # The stat name has to be short, and I recommend you don't use any symbols if you can help it. It MUST be the same as the result